@@ -0,0 +1,54 @@
+"""
+Compares the optimizer backends of minimize_synth (mpfit, brent, least_squares and the grid) on the first star of
+stars_information.csv: vsini, error, number of evaluations of the model (MOOG syntheses in the moog mode) and time.
+MOOG_PATH and MODELS_PATH must be set in vsini_code.py.
+
+    python benchmark_optimizers.py --synth-mode moog --derivative numeric
+"""
+
+import argparse
+import time
+import pandas as pd
+from vsini_code import (LINELIST_PATH, OPTIMIZERS, SYNTH_CACHE, moog_sandbox, create_atm_model, get_obs_spectrum,
+                        get_vmac, interpolation_function, minimize_synth, SPECTRA_PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='evaluations to convergence of the optimizer backends')
+    parser.add_argument('--methods', nargs='+', default=list(OPTIMIZERS) + ['grid'])
+    parser.add_argument('--synth-mode', choices=['moog', 'broaden'], default='moog')
+    parser.add_argument('--derivative', choices=['auto', 'analytic', 'numeric'], default='numeric')
+    parser.add_argument('--start', choices=['auto', 'width', 'fixed'], default='fixed')
+    args = parser.parse_args()
+
+    star_info = pd.read_csv("stars_information.csv").to_dict('records')[0]
+    fe_intervals = pd.read_csv(LINELIST_PATH+'vsini_intervals.list', sep='\t')
+    star = star_info["star_name"]
+    teff = float(star_info["Teff"])
+    logg = float(star_info["logg"])
+    feh = float(star_info["feh"])
+    ldc = float(interpolation_function(teff, logg, feh))
+    vmac = round(float(get_vmac(teff, logg)), 3)
+    instr_broad = float(star_info["instr_broad"])
+    obs_lambda, obs_flux, delta_lambda = get_obs_spectrum(star, SPECTRA_PATH + star_info["fits_name"], fe_intervals)
+
+    # the syntheses of one backend must not be reused by the next one
+    SYNTH_CACHE.path = None
+    rows = []
+    with moog_sandbox(star) as run_dir:
+        create_atm_model(teff, logg, feh, float(star_info["vtur"]), star, run_dir=run_dir)
+        for method in args.methods:
+            SYNTH_CACHE.memory.clear()
+            start = time.perf_counter()
+            result = minimize_synth([5.0], star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, delta_lambda,
+                                    instr_broad, run_dir=run_dir, synth_mode=args.synth_mode, method=method,
+                                    derivative=args.derivative, start=args.start)
+            rows.append([method, result[0], result[1], result[6], result[3], time.perf_counter() - start])
+
+    print('%-14s %8s %8s %12s %12s %9s' % ('method', 'vrot', 'err', 'evaluations', 'chi2', 'time (s)'))
+    for method, vrot, vrot_err, evaluations, chi2, elapsed in rows:
+        print('%-14s %8.3f %8.3f %12d %12.3f %9.2f' % (method, vrot, vrot_err, evaluations, chi2, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compares the time of one iteration of the vsini fit (MOOG synthesis and smoothing of all the chunks and reading of
+synth_fe.asc) with the temporary MOOG files in a RAM backed directory (tmpfs) and on disk.
+It uses the first star of stars_information.csv, so MOOG_PATH and MODELS_PATH must be set in vsini_code.py.
+
+    python benchmark_scratch.py --iterations 20 --tmpfs /dev/shm/ --disk running_dir/
+"""
+
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from vsini_code import (LINELIST_PATH, RUN_PATH, moog_sandbox, create_atm_model, get_vmac, interpolation_function,
+                        moog_fe, read_moog_asc, synthesis_limits)
+
+
+def time_iterations(root, star_info, fe_intervals, iterations):
+    """
+    :param root: string, directory where the MOOG sandbox is created
+    :param star_info: dictionary, one row of stars_information.csv
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :param iterations: int, number of iterations timed
+    :return: array of the time of each iteration in seconds
+    """
+    star = star_info["star_name"]
+    teff = float(star_info["Teff"])
+    logg = float(star_info["logg"])
+    feh = float(star_info["feh"])
+    ldc = float(interpolation_function(teff, logg, feh))
+    vmac = round(float(get_vmac(teff, logg)), 3)
+    CDELT1 = 0.01
+    obs_lambda = np.round(np.arange(np.min(fe_intervals['ll_si']), np.max(fe_intervals['ll_sf']), CDELT1), 3)
+
+    times = []
+    with moog_sandbox(star, root=root) as run_dir:
+        create_atm_model(teff, logg, feh, float(star_info["vtur"]), star, run_dir=run_dir)
+        for i in range(iterations):
+            # a different vsini at each iteration, as in the fit
+            p = [5.0 + 0.01*i]
+            start = time.perf_counter()
+            for lambda_i, lambda_f in zip(*synthesis_limits(obs_lambda)):
+                moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, float(star_info["instr_broad"]),
+                        run_dir=run_dir)
+                read_moog_asc(run_dir + 'synth_fe.asc')
+            times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='latency of one fit iteration with the MOOG files on tmpfs and on disk')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--tmpfs', default='/dev/shm/')
+    parser.add_argument('--disk', default=RUN_PATH)
+    args = parser.parse_args()
+
+    star_info = pd.read_csv("stars_information.csv").to_dict('records')[0]
+    fe_intervals = pd.read_csv(LINELIST_PATH+'vsini_intervals.list', sep='\t')
+
+    results = {}
+    for name, root in [('tmpfs', args.tmpfs), ('disk', args.disk)]:
+        results[name] = time_iterations(root, star_info, fe_intervals, args.iterations)
+
+    print('%-6s %-30s %10s %10s %10s' % ('', 'directory', 'median (s)', 'mean (s)', 'std (s)'))
+    for name, root in [('tmpfs', args.tmpfs), ('disk', args.disk)]:
+        times = results[name]
+        print('%-6s %-30s %10.4f %10.4f %10.4f' % (name, root, np.median(times), np.mean(times), np.std(times)))
+    print('disk / tmpfs (median): %.2f' % (np.median(results['disk'])/np.median(results['tmpfs'])))
+
+
+if __name__ == "__main__":
+    main()
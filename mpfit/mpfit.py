@@ -410,6 +410,8 @@ Perform Levenberg-Marquardt least-squares minimization, based on MINPACK-1.
 
 import numpy
 import types
+import concurrent.futures
+import scipy.linalg
 import scipy.linalg.blas
 
 # 	 Original FORTRAN documentation
@@ -626,6 +628,10 @@ class mpfit:
         diag=None,
         epsfcn=None,
         debug=0,
+        multifcn=None,
+        executor=None,
+        nworkers=None,
+        linalg='minpack',
     ):
         """
   Inputs:
@@ -651,6 +657,16 @@ class mpfit:
 		   NOTE: to supply your own analytical derivatives,
 				 explicitly pass autoderivative=0
 
+	 executor:
+		Evaluates the perturbed parameter vectors of the finite difference
+		derivatives concurrently.  It can be a concurrent.futures.Executor
+		(shut down by the caller), or 'thread' or 'process' to use a
+		ThreadPoolExecutor or ProcessPoolExecutor of NWORKERS workers during
+		the fit.  With a process pool, fcn and functkw must be picklable.  The
+		results are the same as the serial evaluation.  Not used with
+		multifcn.
+		Default: None  The vectors are evaluated one after the other.
+
 	 ftol:
 		A nonnegative input variable. Termination occurs when both the actual
 		and predicted relative reductions in the sum of squares are at most
@@ -721,11 +737,41 @@ class mpfit:
 		Set iterfunct=None if there is no user-defined routine and you don't
 		want the internal default routine be called.
 
+	 linalg:
+		The linear algebra of each iteration.  'minpack' uses the Python
+		translations of the MINPACK routines (qrfac, qrsolv, lmpar and
+		calc_covar).  'lapack' uses the pivoted QR factorization and the
+		triangular solves of scipy.linalg instead (qrfac_lapack,
+		qrsolv_lapack, lmpar_lapack and calc_covar_lapack), which is faster
+		for fits with many parameters and residuals.  The two give the same
+		results to rounding, but the column pivoting of LAPACK can choose a
+		different order when two columns have the same norm.
+		Default: 'minpack'
+
 	 maxiter:
 		The maximum number of iterations to perform.  If the number is exceeded,
 		then the status value is set to 5 and MPFIT returns.
 		Default: 200 iterations
 
+	 multifcn:
+		An optional version of fcn that evaluates several parameter vectors in
+		one call.  When it is given, the finite difference derivatives are
+		computed with a single call of multifcn instead of one call of fcn for
+		each perturbed parameter vector.  It should be declared like this:
+		   def mymultifunct(ps, fjac=None, [functkw keywords here]):
+			   # ps is an array (k, len(p)), one parameter vector per row
+			   status = 0
+			   return [status, deviates]
+		where deviates is an array (k, m) with the weighted deviations of
+		each parameter vector, computed as in fcn.  It receives the same
+		FUNCTKW keywords as fcn.
+		Default: None  The derivatives are computed with fcn.
+
+	 nworkers:
+		The number of workers of the pool when executor is 'thread' or
+		'process'.
+		Default: None  The default of concurrent.futures.
+
 	 nocovar:
 		Set this keyword to prevent the calculation of the covariance matrix
 		before returning (see COVAR)
@@ -862,6 +908,24 @@ class mpfit:
 		   pcerror = mpfit.perror * sqrt(mpfit.fnorm / dof)
 
 		"""
+        if isinstance(executor, str):
+            # The pool only lives during the fit
+            pools = {
+                'thread': concurrent.futures.ThreadPoolExecutor,
+                'process': concurrent.futures.ProcessPoolExecutor,
+            }
+            with pools[executor](max_workers=nworkers) as pool:
+                self.__init__(
+                    fcn, xall=xall, functkw=functkw, parinfo=parinfo,
+                    ftol=ftol, xtol=xtol, gtol=gtol, damp=damp,
+                    maxiter=maxiter, factor=factor, nprint=nprint,
+                    iterfunct=iterfunct, iterkw=iterkw, nocovar=nocovar,
+                    rescale=rescale, autoderivative=autoderivative,
+                    quiet=quiet, diag=diag, epsfcn=epsfcn, debug=debug,
+                    multifcn=multifcn, executor=pool, linalg=linalg,
+                )
+            return
+
         self.niter = 0
         self.params = None
         self.covar = None
@@ -872,6 +936,9 @@ class mpfit:
         self.nfev = 0
         self.damp = damp
         self.dof = 0
+        self.multifcn = multifcn
+        self.executor = executor
+        self.linalg = linalg
 
         if fcn == None:
             self.errmsg = "Usage: parms = mpfit('myfunt', ... )"
@@ -880,6 +947,10 @@ class mpfit:
         if iterfunct == 'default':
             iterfunct = self.defiter
 
+        if linalg not in ['minpack', 'lapack']:
+            self.errmsg = "ERROR: LINALG must be 'minpack' or 'lapack'"
+            return
+
         # Parameter damping doesn't work when user is providing their own
         # gradients.
         if (self.damp != 0) and (autoderivative == 0):
@@ -1145,7 +1216,11 @@ class mpfit:
                             fjac[:, whupeg[i]] = 0
 
             # Compute the QR factorization of the jacobian
-            [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
+            if self.linalg == 'lapack':
+                [fjac, ipvt, qtf, wa2] = self.qrfac_lapack(fjac, fvec)
+                wa1 = numpy.diagonal(fjac).copy()
+            else:
+                [fjac, ipvt, wa1, wa2] = self.qrfac(fjac, pivot=1)
 
             # On the first iteration if "diag" is unspecified, scale
             # according to the norms of the columns of the initial jacobian
@@ -1164,26 +1239,28 @@ class mpfit:
                     delta = factor
 
             # Form (q transpose)*fvec and store the first n components in qtf
+            # (qrfac_lapack already returns qtf and the square triangle of R)
             catch_msg = 'forming (q transpose)*fvec'
-            wa4 = fvec.copy()
-            for j in range(n):
-                lj = ipvt[j]
-                temp3 = fjac[j, lj]
-                if temp3 != 0:
-                    fj = fjac[j:, lj]
-                    wj = wa4[j:]
-                    # *** optimization wa4(j:*)
-                    wa4[j:] = wj - fj * sum(fj * wj) / temp3
-                fjac[j, lj] = wa1[j]
-                qtf[j] = wa4[j]
-            # From this point on, only the square matrix, consisting of the
-            # triangle of R, is needed.
-            fjac = fjac[0:n, 0:n]
-            fjac.shape = [n, n]
-            temp = fjac.copy()
-            for i in range(n):
-                temp[:, i] = fjac[:, ipvt[i]]
-            fjac = temp.copy()
+            if self.linalg != 'lapack':
+                wa4 = fvec.copy()
+                for j in range(n):
+                    lj = ipvt[j]
+                    temp3 = fjac[j, lj]
+                    if temp3 != 0:
+                        fj = fjac[j:, lj]
+                        wj = wa4[j:]
+                        # *** optimization wa4(j:*)
+                        wa4[j:] = wj - fj * sum(fj * wj) / temp3
+                    fjac[j, lj] = wa1[j]
+                    qtf[j] = wa4[j]
+                # From this point on, only the square matrix, consisting of the
+                # triangle of R, is needed.
+                fjac = fjac[0:n, 0:n]
+                fjac.shape = [n, n]
+                temp = fjac.copy()
+                for i in range(n):
+                    temp[:, i] = fjac[:, ipvt[i]]
+                fjac = temp.copy()
 
             # Check for overflow.  This should be a cheap test here since FJAC
             # has been reduced to a (small) square matrix, and the test is
@@ -1218,9 +1295,14 @@ class mpfit:
 
                 # Determine the levenberg-marquardt parameter
                 catch_msg = 'calculating LM parameter (MPFIT_)'
-                [fjac, par, wa1, wa2] = self.lmpar(
-                    fjac, ipvt, diag, qtf, delta, wa1, wa2, par=par
-                )
+                if self.linalg == 'lapack':
+                    [fjac, par, wa1, wa2] = self.lmpar_lapack(
+                        fjac, ipvt, diag, qtf, delta, wa1, wa2, par=par
+                    )
+                else:
+                    [fjac, par, wa1, wa2] = self.lmpar(
+                        fjac, ipvt, diag, qtf, delta, wa1, wa2, par=par
+                    )
                 # Store the direction p and x+p. Calculate the norm of p
                 wa1 = -wa1
 
@@ -1444,7 +1526,10 @@ class mpfit:
             if (n > 0) and (sz[0] >= n) and (sz[1] >= n) and (len(ipvt) >= n):
 
                 catch_msg = 'computing the covariance matrix'
-                cv = self.calc_covar(fjac[0:n, 0:n], ipvt[0:n])
+                if self.linalg == 'lapack':
+                    cv = self.calc_covar_lapack(fjac[0:n, 0:n], ipvt[0:n])
+                else:
+                    cv = self.calc_covar(fjac[0:n, 0:n], ipvt[0:n])
                 cv.shape = [n, n]
                 nn = len(xall)
 
@@ -1585,6 +1670,56 @@ class mpfit:
         else:
             return fcn(x, fjac=fjac, **functkw)
 
+    def call_multi(self, fcn, xs, functkw):
+        # Same as call for a stack of parameter vectors, with the user
+        # function given as MULTIFCN
+        if self.debug:
+            print('Entering call_multi...')
+        xs = numpy.array(xs, dtype=float)
+        if self.qanytied:
+            xs = numpy.array([self.tie(x, self.ptied) for x in xs])
+        self.nfev = self.nfev + len(xs)
+        [status, fs] = fcn(xs, fjac=None, **functkw)
+        fs = numpy.asarray(fs, dtype=float)
+        if self.damp > 0:
+            fs = numpy.tanh(fs / self.damp)
+        return [status, fs]
+
+    def call_columns(self, fcn, xs, functkw):
+        # Evaluates the perturbed parameter vectors of the finite
+        # differences, in order.  Returns None if the user function
+        # asks to stop.
+        if self.multifcn is not None:
+            [status, fs] = self.call_multi(self.multifcn, xs, functkw)
+            if status < 0:
+                return None
+            return list(fs)
+        if self.executor is not None:
+            # Same as call, with the user function run by the executor
+            xs = [numpy.array(xp, dtype=float) for xp in xs]
+            if self.qanytied:
+                xs = [self.tie(xp, self.ptied) for xp in xs]
+            self.nfev = self.nfev + len(xs)
+            futures = [
+                self.executor.submit(fcn, xp, fjac=None, **functkw) for xp in xs
+            ]
+            fs = []
+            for future in futures:
+                [status, fp] = future.result()
+                if status < 0:
+                    return None
+                if self.damp > 0:
+                    fp = numpy.tanh(fp / self.damp)
+                fs.append(fp)
+            return fs
+        fs = []
+        for xp in xs:
+            [status, fp] = self.call(fcn, xp, functkw)
+            if status < 0:
+                return None
+            fs.append(fp)
+        return fs
+
     def enorm(self, vec):
         ans = self.blas_enorm(vec)
         return ans
@@ -1628,22 +1763,23 @@ class mpfit:
             mperr = 0
             fjac = numpy.zeros(nall, dtype=float)
             fjac[ifree] = 1.0  # Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            if status < 0:
+                return None
 
-            if len(fjac) != m * nall:
+            fjac = numpy.asarray(pderiv, dtype=float)
+            if fjac.size != m * nall:
                 print('ERROR: Derivative matrix was not computed properly.')
                 return None
 
             # This definition is consistent with CURVEFIT
             # Sign error found (thanks Jesus Fernandez <fernande@irm.chu-caen.fr>)
-            fjac.shape = [m, nall]
-            fjac = -fjac
+            fjac = -fjac.reshape([m, nall])
 
             # Select only the free parameters
-            if len(ifree) < nall:
-                fjac = fjac[:, ifree]
-                fjac.shape = [m, n]
-                return fjac
+            fjac = fjac[:, ifree]
+            fjac.shape = [m, n]
+            return fjac
 
         fjac = numpy.zeros([m, n], dtype=float)
 
@@ -1678,14 +1814,27 @@ class mpfit:
             wh = (numpy.nonzero(mask))[0]
             if len(wh) > 0:
                 h[wh] = -h[wh]
-        # Loop through parameters, computing the derivative for each
+        # Perturbed parameter vectors, one for each one-sided derivative and
+        # two for each two-sided derivative
+        xs = []
         for j in range(n):
             xp = xall.copy()
             xp[ifree[j]] = xp[ifree[j]] + h[j]
-            [status, fp] = self.call(fcn, xp, functkw)
-            if status < 0:
-                return None
+            xs.append(xp)
+            if numpy.abs(dside[ifree[j]]) > 1:
+                xm = xall.copy()
+                xm[ifree[j]] = xall[ifree[j]] - h[j]
+                xs.append(xm)
+
+        fs = self.call_columns(fcn, xs, functkw)
+        if fs is None:
+            return None
 
+        # Loop through parameters, computing the derivative for each
+        k = 0
+        for j in range(n):
+            fp = fs[k]
+            k = k + 1
             if numpy.abs(dside[ifree[j]]) <= 1:
                 # COMPUTE THE ONE-SIDED DERIVATIVE
                 # Note optimization fjac(0:*,j)
@@ -1693,12 +1842,8 @@ class mpfit:
 
             else:
                 # COMPUTE THE TWO-SIDED DERIVATIVE
-                xp[ifree[j]] = xall[ifree[j]] - h[j]
-
-                mperr = 0
-                [status, fm] = self.call(fcn, xp, functkw)
-                if status < 0:
-                    return None
+                fm = fs[k]
+                k = k + 1
 
                 # Note optimization fjac(0:*,j)
                 fjac[0:, j] = (fp - fm) / (2 * h[j])
@@ -1916,6 +2061,20 @@ class mpfit:
             rdiag[j] = -ajnorm
         return [a, ipvt, rdiag, acnorm]
 
+    def qrfac_lapack(self, a, fvec):
+        # Pivoted QR factorization of a by LAPACK, in the form used by the
+        # main loop after qrfac: the n by n upper triangle of r with its
+        # columns in the pivoted order, ipvt, the first n components of
+        # (q transpose)*fvec and the norms of the columns of a.  q is not
+        # formed, it is applied to fvec directly.
+        if self.debug:
+            print('Entering qrfac_lapack...')
+        acnorm = numpy.linalg.norm(a, axis=0)
+        [qtf, r, ipvt] = scipy.linalg.qr_multiply(
+            a, fvec, mode='right', pivoting=True
+        )
+        return [r, ipvt, qtf, acnorm]
+
     # 	 Original FORTRAN documentation
     # 	 **********
     #
@@ -2070,6 +2229,39 @@ class mpfit:
         x[ipvt] = wa
         return (r, x, sdiag)
 
+    def qrsolv_lapack(self, r, ipvt, diag, qtb, sdiag):
+        # Same as qrsolv, with the givens rotations replaced by the QR
+        # factorization of r stacked over the diagonal matrix d (permuted).
+        # On output the strict lower triangle of r contains the strict upper
+        # triangle (transposed) of s, as in qrsolv.
+        if self.debug:
+            print('Entering qrsolv_lapack...')
+        n = r.shape[1]
+        rd = numpy.vstack([numpy.triu(r), numpy.diag(diag[ipvt])])
+        [wa, s] = scipy.linalg.qr_multiply(
+            rd, numpy.append(qtb, numpy.zeros(n)), mode='right'
+        )
+        sdiag = numpy.diagonal(s).copy()
+        lower = numpy.tril_indices(n, -1)
+        r[lower] = s.T[lower]
+
+        # Solve the triangular system for z.  If the system is singular
+        # then obtain a least squares solution
+        nsing = n
+        wh = (numpy.nonzero(sdiag == 0))[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa[nsing:] = 0
+        if nsing >= 1:
+            wa[0:nsing] = scipy.linalg.solve_triangular(
+                s[0:nsing, 0:nsing], wa[0:nsing]
+            )
+
+        # Permute the components of z back to components of x
+        x = numpy.zeros(n, dtype=float)
+        x[ipvt] = wa
+        return (r, x, sdiag)
+
     # 	 Original FORTRAN documentation
     #
     # 	 subroutine lmpar
@@ -2281,6 +2473,111 @@ class mpfit:
         # Termination
         return [r, par, x, sdiag]
 
+    def lmpar_lapack(self, r, ipvt, diag, qtb, delta, x, sdiag, par=None):
+        # Same as lmpar, with the triangular systems solved by LAPACK and
+        # qrsolv_lapack instead of qrsolv.  Only the upper triangle of r is
+        # read, the strict lower triangle holds s from qrsolv_lapack.
+        if self.debug:
+            print('Entering lmpar_lapack...')
+        dwarf = self.machar.minnum
+        machep = self.machar.machep
+        n = r.shape[1]
+
+        # Compute and store in x the gauss-newton direction.  If the
+        # jacobian is rank-deficient, obtain a least-squares solution
+        nsing = n
+        wa1 = qtb.copy()
+        rthresh = numpy.max(numpy.abs(numpy.diagonal(r))) * machep
+        wh = (numpy.nonzero(numpy.abs(numpy.diagonal(r)) < rthresh))[0]
+        if len(wh) > 0:
+            nsing = wh[0]
+            wa1[wh[0] :] = 0
+        if nsing >= 1:
+            wa1[0:nsing] = scipy.linalg.solve_triangular(
+                r[0:nsing, 0:nsing], wa1[0:nsing]
+            )
+
+        # Note: ipvt here is a permutation array
+        x[ipvt] = wa1
+
+        # Initialize the iteration counter.  Evaluate the function at the
+        # origin, and test for acceptance of the gauss-newton direction
+        iter = 0
+        wa2 = diag * x
+        dxnorm = self.enorm(wa2)
+        fp = dxnorm - delta
+        if fp <= 0.1 * delta:
+            return [r, 0.0, x, sdiag]
+
+        # If the jacobian is not rank deficient, the newton step provides a
+        # lower bound, parl, for the zero of the function.  Otherwise set
+        # this bound to zero.
+        parl = 0.0
+        if nsing >= n:
+            wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
+            wa1 = scipy.linalg.solve_triangular(r, wa1, trans='T')
+            temp = self.enorm(wa1)
+            parl = ((fp / delta) / temp) / temp
+
+        # Calculate an upper bound, paru, for the zero of the function
+        wa1 = numpy.dot(qtb, numpy.triu(r)) / diag[ipvt]
+        gnorm = self.enorm(wa1)
+        paru = gnorm / delta
+        if paru == 0:
+            paru = dwarf / numpy.min([delta, 0.1])
+
+        # If the input par lies outside of the interval (parl,paru), set
+        # par to the closer endpoint
+        par = numpy.max([par, parl])
+        par = numpy.min([par, paru])
+        if par == 0:
+            par = gnorm / dxnorm
+
+        # Beginning of an interation
+        while 1:
+            iter = iter + 1
+
+            # Evaluate the function at the current value of par
+            if par == 0:
+                par = numpy.max([dwarf, paru * 0.001])
+            temp = numpy.sqrt(par)
+            wa1 = temp * diag
+            [r, x, sdiag] = self.qrsolv_lapack(r, ipvt, wa1, qtb, sdiag)
+            wa2 = diag * x
+            dxnorm = self.enorm(wa2)
+            temp = fp
+            fp = dxnorm - delta
+
+            if (
+                (numpy.abs(fp) <= 0.1 * delta)
+                or ((parl == 0) and (fp <= temp) and (temp < 0))
+                or (iter == 10)
+            ):
+                break
+
+            # Compute the newton correction, with s transpose in the lower
+            # triangle of r and the diagonal of s in sdiag
+            wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
+            st = numpy.tril(r, -1) + numpy.diag(sdiag)
+            wa1 = scipy.linalg.solve_triangular(st, wa1, lower=True)
+
+            temp = self.enorm(wa1)
+            parc = ((fp / delta) / temp) / temp
+
+            # Depending on the sign of the function, update parl or paru
+            if fp > 0:
+                parl = numpy.max([parl, par])
+            if fp < 0:
+                paru = numpy.min([paru, par])
+
+            # Compute an improved estimate for par
+            par = numpy.max([parl, par + parc])
+
+            # End of an iteration
+
+        # Termination
+        return [r, par, x, sdiag]
+
     # Procedure to tie one parameter to another.
     def tie(self, p, ptied=None):
         if self.debug:
@@ -2425,6 +2722,42 @@ class mpfit:
 
         return r
 
+    def calc_covar_lapack(self, rr, ipvt=None, tol=1.0e-14):
+        # Same as calc_covar, with the inverse of r computed by LAPACK
+        if self.debug:
+            print('Entering calc_covar_lapack...')
+        if numpy.ndim(rr) != 2:
+            print('ERROR: r must be a two-dimensional matrix')
+            return -1
+        s = rr.shape
+        n = s[0]
+        if s[0] != s[1]:
+            print('ERROR: r must be a square matrix')
+            return -1
+
+        if ipvt is None:
+            ipvt = numpy.arange(n)
+        r = numpy.triu(rr)
+
+        # The first l columns of r, up to the first diagonal element not
+        # above tol*abs(r(1,1)), define the rank
+        tolr = tol * numpy.abs(r[0, 0])
+        wh = (numpy.nonzero(numpy.abs(numpy.diagonal(r)) <= tolr))[0]
+        l = n
+        if len(wh) > 0:
+            l = wh[0]
+
+        # inverse((r transpose)*r) of those columns, zero for the others
+        cv = numpy.zeros([n, n], dtype=float)
+        if l > 0:
+            rinv = scipy.linalg.solve_triangular(r[0:l, 0:l], numpy.identity(l))
+            cv[0:l, 0:l] = numpy.dot(rinv, rinv.T)
+
+        # Permute the rows and columns back to the order of the parameters
+        covar = numpy.zeros([n, n], dtype=float)
+        covar[numpy.ix_(ipvt, ipvt)] = cv
+        return covar
+
 
 class machar:
     def __init__(self, double=1):
@@ -0,0 +1,81 @@
+"""
+Compares the fits of mpfit with the finite difference derivatives evaluated one after the other, by a pool of
+workers (executor) and by one call of multifcn: all of them must give the same result.
+
+    python -m pytest mpfit/test_mpfit_executor.py
+"""
+
+import concurrent.futures
+
+import numpy
+import pytest
+
+from mpfit import mpfit
+
+
+def model(p, x):
+    p = numpy.reshape(p, (-1, 3))
+    return numpy.sum(p[:, 0:1] * numpy.exp(-0.5 * ((x - p[:, 1:2]) / p[:, 2:3]) ** 2), axis=0)
+
+
+# module level functions, so that the process pool can pickle them
+def fcn(p, fjac=None, x=None, y=None, err=None):
+    return [0, (y - model(p, x)) / err]
+
+
+def multifcn(ps, fjac=None, x=None, y=None, err=None):
+    return [0, numpy.array([(y - model(p, x)) / err for p in ps])]
+
+
+def gaussians_problem(ngauss=3, npoints=1000, seed=3):
+    rng = numpy.random.default_rng(seed)
+    x = numpy.linspace(0, 100, npoints)
+    centers = numpy.linspace(15, 85, ngauss)
+    p_true = numpy.column_stack([rng.uniform(1, 3, ngauss), centers, rng.uniform(1, 2, ngauss)]).ravel()
+    err = 0.05
+    y = model(p_true, x) + rng.normal(0, err, npoints)
+    parinfo = [{'value': value, 'fixed': 0, 'limited': [0, 0], 'limits': [0., 0.], 'step': 0, 'mpside': 0}
+               for value in p_true * (1 + rng.normal(0, 0.02, p_true.size))]
+    # two sided and one sided derivatives, a fixed parameter and one pegged at a limit
+    parinfo[1]['mpside'] = 2
+    parinfo[2]['step'] = 0.001
+    parinfo[3]['fixed'] = 1
+    parinfo[5]['limited'] = [1, 1]
+    parinfo[5]['limits'] = [0.5, parinfo[5]['value']]
+    return parinfo, {'x': x, 'y': y, 'err': err}
+
+
+def assert_same_fit(fit, serial):
+    assert fit.status == serial.status, fit.errmsg
+    numpy.testing.assert_array_equal(fit.params, serial.params)
+    numpy.testing.assert_array_equal(fit.perror, serial.perror)
+    assert fit.nfev == serial.nfev
+    assert fit.niter == serial.niter
+
+
+@pytest.fixture(scope='module')
+def problem():
+    parinfo, functkw = gaussians_problem()
+    serial = mpfit(fcn, parinfo=parinfo, functkw=functkw, quiet=1)
+    assert serial.status > 0, serial.errmsg
+    return parinfo, functkw, serial
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_executor(problem, executor):
+    parinfo, functkw, serial = problem
+    fit = mpfit(fcn, parinfo=parinfo, functkw=functkw, quiet=1, executor=executor, nworkers=2)
+    assert_same_fit(fit, serial)
+
+
+def test_executor_instance(problem):
+    parinfo, functkw, serial = problem
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+        fit = mpfit(fcn, parinfo=parinfo, functkw=functkw, quiet=1, executor=pool)
+    assert_same_fit(fit, serial)
+
+
+def test_multifcn(problem):
+    parinfo, functkw, serial = problem
+    fit = mpfit(fcn, parinfo=parinfo, functkw=functkw, quiet=1, multifcn=multifcn)
+    assert_same_fit(fit, serial)
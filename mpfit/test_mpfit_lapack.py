@@ -0,0 +1,191 @@
+"""
+Compares the LAPACK linear algebra of mpfit (linalg='lapack') with the translations of the MINPACK routines.
+
+    python -m pytest mpfit/test_mpfit_lapack.py
+"""
+
+import numpy
+import pytest
+
+from mpfit import mpfit, machar
+
+
+def routines():
+    # mpfit instance with the machine constants set, to call the routines directly
+    m = mpfit(None)
+    m.machar = machar(double=1)
+    m.blas_enorm = mpfit.blas_enorm64
+    return m
+
+
+def minpack_factorization(m, a, fvec):
+    """
+    qrfac followed by the steps of the main loop of mpfit that form (q transpose)*fvec and the square triangle of r.
+    :return: r (columns in the pivoted order), ipvt, qtf and the norms of the columns of a
+    """
+    n = a.shape[1]
+    [a, ipvt, rdiag, acnorm] = m.qrfac(a.copy(), pivot=1)
+    wa4 = fvec.copy()
+    qtf = numpy.zeros(n)
+    for j in range(n):
+        lj = ipvt[j]
+        if a[j, lj] != 0:
+            fj = a[j:, lj]
+            wa4[j:] = wa4[j:] - fj * sum(fj * wa4[j:]) / a[j, lj]
+        a[j, lj] = rdiag[j]
+        qtf[j] = wa4[j]
+    return a[0:n, 0:n][:, ipvt].copy(), ipvt, qtf, acnorm
+
+
+def random_problem(n, m=500, seed=1):
+    rng = numpy.random.default_rng(seed)
+    return rng.normal(size=(m, n)), rng.normal(size=m)
+
+
+@pytest.mark.parametrize('n', [1, 3, 10, 40])
+def test_qrfac(n):
+    m = routines()
+    a, fvec = random_problem(n)
+    r1, ipvt1, qtf1, acnorm1 = minpack_factorization(m, a, fvec)
+    r2, ipvt2, qtf2, acnorm2 = m.qrfac_lapack(a.copy(), fvec)
+
+    numpy.testing.assert_array_equal(ipvt1, ipvt2)
+    numpy.testing.assert_allclose(acnorm1, acnorm2, rtol=1e-12)
+    # r and qtf are the same up to the sign of each row
+    r1 = numpy.triu(r1)
+    numpy.testing.assert_allclose(r1.T @ r1, r2.T @ r2, rtol=1e-10, atol=1e-10)
+    numpy.testing.assert_allclose(r1.T @ qtf1, r2.T @ qtf2, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('n', [1, 3, 10, 40])
+@pytest.mark.parametrize('delta', [1e-3, 1e-1, 1e3])
+def test_lmpar(n, delta):
+    m = routines()
+    a, fvec = random_problem(n)
+    r1, ipvt1, qtf1, acnorm = minpack_factorization(m, a, fvec)
+    r2, ipvt2, qtf2, acnorm = m.qrfac_lapack(a.copy(), fvec)
+
+    [r1, par1, x1, sdiag1] = m.lmpar(r1, ipvt1, acnorm, qtf1, delta, numpy.zeros(n), numpy.zeros(n), par=0.0)
+    [r2, par2, x2, sdiag2] = m.lmpar_lapack(r2, ipvt2, acnorm, qtf2, delta, numpy.zeros(n), numpy.zeros(n), par=0.0)
+    assert par2 == pytest.approx(par1, rel=1e-8, abs=1e-12)
+    numpy.testing.assert_allclose(x1, x2, rtol=1e-8, atol=1e-12 * numpy.max(numpy.abs(x1)))
+
+
+@pytest.mark.parametrize('n', [3, 10])
+def test_qrsolv(n):
+    m = routines()
+    a, fvec = random_problem(n)
+    r, ipvt, qtf, acnorm = minpack_factorization(m, a, fvec)
+    diag = 0.3 * acnorm
+    [r1, x1, sdiag1] = m.qrsolv(r.copy(), ipvt, diag, qtf, numpy.zeros(n))
+    [r2, x2, sdiag2] = m.qrsolv_lapack(r.copy(), ipvt, diag, qtf, numpy.zeros(n))
+    numpy.testing.assert_allclose(x1, x2, rtol=1e-10, atol=1e-14)
+    numpy.testing.assert_allclose(numpy.abs(sdiag1), numpy.abs(sdiag2), rtol=1e-10)
+    # the upper triangle of r is kept
+    numpy.testing.assert_array_equal(numpy.triu(r2), numpy.triu(r))
+
+
+@pytest.mark.parametrize('n', [1, 3, 10, 40])
+def test_calc_covar(n):
+    m = routines()
+    a, fvec = random_problem(n)
+    r, ipvt, qtf, acnorm = minpack_factorization(m, a, fvec)
+    covar1 = m.calc_covar(r.copy(), ipvt)
+    covar2 = m.calc_covar_lapack(r.copy(), ipvt)
+    numpy.testing.assert_allclose(covar1, covar2, rtol=1e-10, atol=1e-14 * numpy.max(numpy.abs(covar1)))
+    # covariance of the unscaled least squares problem
+    numpy.testing.assert_allclose(covar2, numpy.linalg.inv(a.T @ a), rtol=1e-8, atol=1e-14)
+
+
+@pytest.mark.parametrize('n, rank', [(5, 3), (10, 1), (4, 0)])
+def test_calc_covar_rank_deficient(n, rank):
+    m = routines()
+    a, fvec = random_problem(n)
+    r, ipvt, qtf, acnorm = minpack_factorization(m, a, fvec)
+    r[rank:, rank:] = 0
+    numpy.testing.assert_allclose(m.calc_covar(r.copy(), ipvt), m.calc_covar_lapack(r.copy(), ipvt),
+                                  rtol=1e-10, atol=1e-14)
+
+
+@pytest.mark.parametrize('n, rank', [(5, 3), (10, 1)])
+@pytest.mark.parametrize('delta', [1e-3, 1e3])
+def test_lmpar_rank_deficient(n, rank, delta):
+    m = routines()
+    a, fvec = random_problem(n)
+    r, ipvt, qtf, acnorm = minpack_factorization(m, a, fvec)
+    r[rank:, rank:] = 0
+    [_, par1, x1, _] = m.lmpar(r.copy(), ipvt, acnorm, qtf, delta, numpy.zeros(n), numpy.zeros(n), par=0.0)
+    [_, par2, x2, _] = m.lmpar_lapack(r.copy(), ipvt, acnorm, qtf, delta, numpy.zeros(n), numpy.zeros(n), par=0.0)
+    assert par2 == pytest.approx(par1, rel=1e-8, abs=1e-12)
+    numpy.testing.assert_allclose(x1, x2, rtol=1e-8, atol=1e-12 * numpy.max(numpy.abs(x1)))
+
+
+@pytest.mark.parametrize('delta', [1e-2, 1., 1e3])
+def test_lmpar_dependent_columns(delta):
+    # with columns that are combinations of others, the rounding decides which diagonal elements of r are taken as
+    # zero, so the steps of the two paths can differ; both must satisfy the conditions of lmpar
+    m = routines()
+    n = 6
+    a, fvec = random_problem(n)
+    a[:, 4] = a[:, 0]
+    a[:, 5] = 2 * a[:, 1]
+    r, ipvt, qtf, acnorm = m.qrfac_lapack(a.copy(), fvec)
+    [_, par, x, _] = m.lmpar_lapack(r, ipvt, acnorm, qtf, delta, numpy.zeros(n), numpy.zeros(n), par=0.0)
+    dxnorm = numpy.linalg.norm(acnorm * x)
+    assert numpy.all(numpy.isfinite(x))
+    if par == 0:
+        assert dxnorm <= 1.1 * delta
+    else:
+        assert abs(dxnorm - delta) <= 0.1 * delta
+
+
+def gaussians_problem(ngauss=5, npoints=2000, seed=2):
+    rng = numpy.random.default_rng(seed)
+    x = numpy.linspace(0, 100, npoints)
+    centers = numpy.linspace(10, 90, ngauss)
+    p_true = numpy.column_stack([rng.uniform(1, 3, ngauss), centers, rng.uniform(1, 2, ngauss)]).ravel()
+
+    def model(p):
+        p = numpy.reshape(p, (-1, 3))
+        return numpy.sum(p[:, 0:1] * numpy.exp(-0.5 * ((x - p[:, 1:2]) / p[:, 2:3]) ** 2), axis=0)
+
+    y = model(p_true) + rng.normal(0, 0.05, npoints)
+
+    def fcn(p, fjac=None):
+        return [0, (y - model(p)) / 0.05]
+
+    p_start = p_true * (1 + rng.normal(0, 0.02, p_true.size))
+    return fcn, p_start
+
+
+@pytest.mark.parametrize('ngauss', [1, 5])
+def test_fit(ngauss):
+    fcn, p_start = gaussians_problem(ngauss)
+    fits = [mpfit(fcn, p_start, linalg=linalg, quiet=1) for linalg in ['minpack', 'lapack']]
+    for fit in fits:
+        assert fit.status > 0, fit.errmsg
+    numpy.testing.assert_allclose(fits[1].params, fits[0].params, rtol=1e-8)
+    numpy.testing.assert_allclose(fits[1].perror, fits[0].perror, rtol=1e-6)
+    numpy.testing.assert_allclose(fits[1].covar, fits[0].covar, rtol=1e-6, atol=1e-12)
+    assert fits[1].fnorm == pytest.approx(fits[0].fnorm, rel=1e-10)
+
+
+def test_fit_limits():
+    fcn, p_start = gaussians_problem(3)
+    parinfo = [{'value': value, 'fixed': 0, 'limited': [0, 0], 'limits': [0., 0.]} for value in p_start]
+    parinfo[0]['fixed'] = 1
+    # a width pegged at its upper limit
+    parinfo[2]['limited'] = [1, 1]
+    parinfo[2]['limits'] = [0.5, p_start[2]]
+    fits = [mpfit(fcn, parinfo=parinfo, linalg=linalg, quiet=1) for linalg in ['minpack', 'lapack']]
+    for fit in fits:
+        assert fit.status > 0, fit.errmsg
+    numpy.testing.assert_allclose(fits[1].params, fits[0].params, rtol=1e-8)
+    numpy.testing.assert_allclose(fits[1].perror, fits[0].perror, rtol=1e-6, atol=1e-12)
+
+
+def test_linalg_keyword():
+    fcn, p_start = gaussians_problem(1)
+    fit = mpfit(fcn, p_start, linalg='blas', quiet=1)
+    assert fit.status == 0
+    assert 'LINALG' in fit.errmsg
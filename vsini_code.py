@@ -5,12 +5,31 @@ from multiprocessing.pool import RUN
 from ssl import get_server_certificate
 import time
 import os
+import shutil
+import tempfile
+import argparse
+import traceback
+import subprocess
+import glob
+import hashlib
+import io
+import re
+import zipfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 from astropy.io import fits
 from scipy.interpolate import interp1d
+from scipy.fft import rfft, irfft, next_fast_len
+from scipy.special import erfc
+from scipy.optimize import minimize_scalar, least_squares
+from types import SimpleNamespace
 import pandas as pd
 import sys
-sys.path.insert(0, os.path.dirname(repr(__file__).replace("'",""))+'mpfit/')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mpfit'))
 from mpfit import mpfit
 from matplotlib import pyplot as plt
 from csv import writer
@@ -23,6 +42,117 @@ MOOG_PATH     = "/home/pedro/OneDrive/Documentos/codes/MOOG2019/./"  # otherwise
 MODELS_PATH   = "/home/pedro/OneDrive/Documentos/codes/interpol_models/./"
 LINELIST_PATH = 'linelist/'
 SPECTRA_PATH = 'Spectra/'
+LITERATURE_FILE = 'Literature_values.txt'
+# transient MOOG and atmosphere files go to a RAM backed directory when it exists, only the .rdb products are saved
+# in RUN_PATH
+SCRATCH_PATH  = '/dev/shm/' if os.path.isdir('/dev/shm') else RUN_PATH
+MOOG_TIMEOUT  = 300  # seconds allowed for one call of MOOGSILENT, intermod.e or transform.e
+SYNTH_CACHE_PATH = RUN_PATH + 'synth_cache/'  # set to None to keep the synthesis cache only in memory
+ATM_CACHE_PATH = RUN_PATH + 'atm_cache/'  # interpolated atmosphere models, set to None to always run intermod.e
+OBS_CACHE_PATH = RUN_PATH + 'obs_cache/'  # normalized observed spectra, set to None to always read the FITS files
+OBS_CACHE_VERSION = 1  # part of the key of the observed spectra, increase it when the rounding of the wavelengths and
+                       # the step, the interpolation or the normalization change
+SYNTH_CACHE_MEMORY_ITEMS = 256
+SYNTH_CACHE_MAX_BYTES = 2 * 1024**3
+LIGHT_SPEED   = 299792.458  # km/s
+VSINI_LIMITS  = [0.1, 60]  # km/s, limits of vsini in the fits
+# fits of the Teff and [Fe/H] perturbations in get_vsini_error, started from the nominal vsini
+ERROR_FIT_WINDOW  = 1.0   # km/s, minimum half width of the vsini limits around the nominal value
+ERROR_FIT_TOL     = 0.01  # km/s, change of vsini below which the fit stops
+ERROR_FIT_MAXITER = 10
+# Monte Carlo errors: the drawn Teff and [Fe/H] are rounded to steps of their errors divided by this number, so that
+# draws with the same atmosphere model share one unsmoothed synthesis
+MC_ATM_STEPS_PER_SIGMA = 2
+MC_PERCENTILES = [2.5, 16, 50, 84, 97.5]
+LINE_OUTLIER_SIGMA = 3.0  # per line fits: lines further than this from the median (in their error and the scatter of
+                          # the lines) are outliers
+LINE_WIDTH_SMOOTH = 5  # points of the running mean applied to the lines before measuring their widths (start='width')
+
+
+def run_program(program, run_dir, stdin_text, timeout=MOOG_TIMEOUT):
+    """
+    Runs an external program (MOOGSILENT, intermod.e, transform.e) directly, without starting a shell.
+    :param program: string, path of the executable (or name of an executable in the PATH)
+    :param run_dir: string, working directory of the program
+    :param stdin_text: string, text sent to the standard input of the program
+    :param timeout: float, maximum time in seconds before the program is killed
+    :return: subprocess.CompletedProcess with the return code, stdout and stderr
+    """
+    if os.path.dirname(program):
+        program = os.path.abspath(program)
+    try:
+        result = subprocess.run([program], input=stdin_text, cwd=run_dir, capture_output=True, text=True,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError('%s did not finish in %s s (working directory %s)' % (program, timeout, run_dir))
+    if result.returncode != 0:
+        raise RuntimeError('%s returned %d (working directory %s): %s' % (program, result.returncode, run_dir,
+                                                                         result.stderr.strip()))
+    return result
+
+
+@contextmanager
+def moog_sandbox(star, root=None):
+    """
+    Context manager that creates a private working directory for one fit, so that several MOOG runs can proceed at
+    the same time without overwriting each other's .atm, .par and .asc files. The directory is removed on exit.
+    :param star: string, star name (used as prefix of the directory name)
+    :param root: string, directory where the sandbox is created (default: SCRATCH_PATH)
+    :return: string, path of the sandbox ending with '/'
+    """
+    if root is None:
+        root = SCRATCH_PATH
+    run_dir = tempfile.mkdtemp(prefix='vsini_' + star.replace(' ', '_') + '_', dir=root) + '/'
+    try:
+        yield run_dir
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def atomic_write(path, write_function):
+    """
+    Writes a file through a temporary name in the same directory and renames it, so that other processes and threads
+    never read a half written file.
+    :param path: string, path of the file
+    :param write_function: function called with the temporary file opened in binary mode
+    """
+    tmp_file = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_file, 'wb') as tmp:
+            write_function(tmp)
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def continuum_levels(segments, max_it=15):
+    """
+    Mean flux of the continuum of several intervals at once. In each pass the points below m-sigma or above m+2*sigma
+    (m and sigma of the points kept so far in the interval) are rejected, until no point is rejected or after max_it
+    passes.
+    :param segments: list of arrays of floats, data points (e.g. flux) of each interval
+    :param max_it: int, maximum number of passes
+    :return: array of floats, mean value of the data points kept in each interval
+    """
+    lengths = np.array([len(segment) for segment in segments])
+    flux = np.zeros((len(segments), max(int(np.max(lengths)), 1)))
+    keep = np.arange(flux.shape[1]) < lengths[:, None]
+    for i, segment in enumerate(segments):
+        flux[i, :lengths[i]] = segment
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for it in range(max_it):
+            n = np.sum(keep, axis=1)
+            m = np.sum(np.where(keep, flux, 0), axis=1) / n
+            sigma = np.sqrt(np.sum(np.where(keep, (flux - m[:, None])**2, 0), axis=1) / n)
+            clipped = keep & ((flux < (m - sigma)[:, None]) | (flux > (m + 2*sigma)[:, None]))
+            if not np.any(clipped):
+                return m
+            keep &= ~clipped
+        return np.sum(np.where(keep, flux, 0), axis=1) / np.sum(keep, axis=1)
+
 
 def norm(obs_array_complete):
     """
@@ -30,25 +160,9 @@ def norm(obs_array_complete):
     :param obs_array_complete: list of floats of data points (e.g. flux)
     :return: m, float, mean value of data points
     """
-    obs_array_complete = list(obs_array_complete)
-    obs_array = obs_array_complete.copy()
-    m = np.mean(obs_array_complete)
-    sigma = np.std(obs_array_complete)
-
-    # define maximum iterations as desired
-    max_it=15
-    it = 0
-    while it < max_it:
-        for data_value in obs_array:
-            if data_value < m-sigma or data_value > m+2*sigma:
-                obs_array.remove(data_value)
-            m = np.mean(obs_array)
-            sigma = np.std(obs_array)
-        it = it + 1
-
-    return m
+    return continuum_levels([np.asarray(obs_array_complete, dtype=float)])[0]
 
-def moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad):
+def moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad, run_dir=RUN_PATH, smooth=True):
     """
     This function outputs a parameter file with the given details, outputs a text file and calls MOOGSILENT to read
     these files. In turn, MOOGSILENT will output an ascii file of a synthetic spectrum for the given star properties.
@@ -61,27 +175,40 @@ def moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad):
     :param ldc: float, limb darkening coefficient
     :param CDELT1: float, delta lambda in the observed spectrum
     :param instr_broad: float, instrumental broadening
-    :return: .par file, .txt file, runs them through MOOGSILENT and returns a message of completion
+    :param run_dir: string, working directory of MOOG (must contain the star .atm file)
+    :param smooth: bool, if False MOOG does not smooth the spectrum and only the unbroadened synthesis is written in
+                   out1 (p, vmac, ldc and instr_broad are then ignored)
+    :return: .par file, runs it through MOOGSILENT and returns a message of completion
     """
 
     print (star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad)
 
-    with open(RUN_PATH+'synth_fe.par', 'w') as par:
+    linelist = os.path.relpath(os.path.abspath(LINELIST_PATH+'iron_vrot_moog.list'), os.path.abspath(run_dir))
+    if len(linelist) > 70:
+        # MOOG reads file names of up to 80 characters, use a link when the scratch directory is far from the code
+        if not os.path.exists(run_dir+'iron_vrot_moog.list'):
+            os.symlink(os.path.abspath(LINELIST_PATH+'iron_vrot_moog.list'), run_dir+'iron_vrot_moog.list')
+        linelist = 'iron_vrot_moog.list'
+
+    with open(run_dir+'synth_fe.par', 'w') as par:
         par.write('synth \n')
         par.write('model_in       \'' + star + '.atm\' \n')
         par.write('summary_out    \'out1\' \n')
         par.write('smoothed_out   \'synth_fe.asc\' \n')
         par.write('standard_out   \'out2\' \n')
-        par.write('lines_in       \'../linelist/iron_vrot_moog.list\' \n')
+        par.write('lines_in       \'' + linelist + '\' \n')
         par.write('abundances     1    1\n')
         par.write('        26     0.00 \n')
-        par.write('plot           1 \n')
+        par.write('plot           ' + ('1' if smooth else '0') + ' \n')
         par.write('synlimits \n')
         par.write(str(lambda_i) + '  ' + str(lambda_f) + '   ' + str(round(CDELT1, 3)) + '  1.0 \n')
-        par.write('plotpars       1 \n')
-        par.write(str(lambda_i) + '   ' + str(lambda_f) + '  0.80   1.05 \n')
-        par.write('0.0   0.0   0.0   1.0  \n')
-        par.write('r  ' + str(round(instr_broad, 3)) + '  ' + str(round(p[0], 3)) + '  ' + str(round(ldc, 3)) + '  ' + str(round(vmac, 3)) + '  0.0 \n')
+        if smooth:
+            par.write('plotpars       1 \n')
+            par.write(str(lambda_i) + '   ' + str(lambda_f) + '  0.80   1.05 \n')
+            par.write('0.0   0.0   0.0   1.0  \n')
+            par.write('r  ' + str(round(instr_broad, 3)) + '  ' + str(round(p[0], 3)) + '  ' + str(round(ldc, 3)) + '  ' + str(round(vmac, 3)) + '  0.0 \n')
+        else:
+            par.write('plotpars       0 \n')
         par.write('damping        0 \n')
         par.write('atmosphere     1 \n')
         par.write('molecules      2 \n')
@@ -93,18 +220,802 @@ def moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad):
         par.write('opacit         0 \n')
         par.write('obspectrum     0 \n')
 
-    with open(RUN_PATH+'synth_fe.txt', 'w') as txt:
-        txt.write('synth_fe.par \n')
-        txt.write('f \n')
-        #txt.write(star + '_fe.ps \n')
-        txt.write('q \n')
+    if os.path.exists(run_dir+'batch.par'):
+        os.remove(run_dir+'batch.par')
+    # answers to the MOOG prompts (previously written in synth_fe.txt)
+    result = run_program(MOOG_PATH+'MOOGSILENT', run_dir, 'synth_fe.par \nf \nq \n')
+
+    return 'Finished MOOG synthesis for ' + star + ' in range ' + str(lambda_i) + ' to ' + str(lambda_f) + \
+           ' (return code ' + str(result.returncode) + ').'
+
+class SynthesisCache:
+    """
+    Cache of MOOG synthetic spectra, keyed by a hash of the atmosphere model, the line list and every value written
+    in the .par file by moog_fe. It has an in-memory LRU layer and an optional on-disk layer (one .npy file per
+    synthesis) that is shared by all the processes and trimmed to max_bytes, removing the least recently used files.
+    The directory is created by the first put. The size of the directory is scanned by the first put and then
+    counted from the files written by this process, and scanned again only when the count goes over max_bytes.
+    """
+
+    def __init__(self, path=SYNTH_CACHE_PATH, max_items=SYNTH_CACHE_MEMORY_ITEMS, max_bytes=SYNTH_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        # the Jacobian threads of mpfit share the cache
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # bytes of the files in path, None until the first scan
+        self.total_bytes = None
+
+    def key(self, atm_file, *inputs):
+        """
+        :param atm_file: string, path of the atmosphere model used in the synthesis
+        :param inputs: values written in the .par file (already rounded as MOOG sees them)
+        :return: string, hexadecimal hash of the synthesis
+        """
+        sha = hashlib.sha256()
+        with open(atm_file, 'rb') as atm:
+            sha.update(atm.read())
+        with open(LINELIST_PATH+'iron_vrot_moog.list', 'rb') as linelist:
+            sha.update(linelist.read())
+        sha.update(repr(inputs).encode())
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        :param key: string, hash from SynthesisCache.key
+        :return: tuple of arrays (wavelength, flux) or None if the synthesis is not in the cache
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+        if self.path is not None:
+            file_name = self.path + key + '.npy'
+            try:
+                synth = np.load(file_name)
+                os.utime(file_name)
+            except (OSError, ValueError):
+                synth = None
+            if synth is not None:
+                self._remember(key, (synth[0], synth[1]))
+                with self.lock:
+                    self.hits += 1
+                return synth[0], synth[1]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, synth_lambda, synth_data):
+        self._remember(key, (synth_lambda, synth_data))
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        file_name = self.path + key + '.npy'
+        atomic_write(file_name, lambda tmp: np.save(tmp, np.vstack((synth_lambda, synth_data))))
+        size = os.path.getsize(file_name)
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += size
+            scan = self.total_bytes is None or self.total_bytes > self.max_bytes
+        if scan:
+            self._evict()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def add_stats(self, stats):
+        """
+        Adds the hits and misses of a worker process (from cache_counted), so that stats covers the fits run there.
+        :param stats: dictionary with the hits and misses to add
+        """
+        with self.lock:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+
+    def _remember(self, key, synth):
+        with self.lock:
+            self.memory[key] = synth
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def _evict(self):
+        files = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((info.st_mtime, info.st_size, entry.path))
+                total += info.st_size
+        for mtime, size, file_name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self.lock:
+            self.total_bytes = total
+
+
+SYNTH_CACHE = SynthesisCache()
+
+
+def cache_counted(function, *args, **kwargs):
+    """
+    Runs function, in a worker process, and returns its result with the synthesis cache hits and misses of the call.
+    :return: tuple (result of function, dictionary of hits and misses)
+    """
+    start = SYNTH_CACHE.stats()
+    result = function(*args, **kwargs)
+    end = SYNTH_CACHE.stats()
+    return result, {name: end[name] - start[name] for name in end}
+
+
+def counted_result(future):
+    """
+    :param future: future of cache_counted submitted to a process pool
+    :return: result of the function, after adding the cache hits and misses of the worker to SYNTH_CACHE
+    """
+    result, stats = future.result()
+    SYNTH_CACHE.add_stats(stats)
+    return result
+
+
+def read_moog_asc(file_name):
+    """
+    Reads the smoothed synthetic spectrum written by MOOG (smoothed_out, e.g. synth_fe.asc) in one call. The two header
+    lines are validated against the data: number of points, start and step of the synthesis.
+    :param file_name: string, path of the smoothed_out file
+    :return: arrays of wavelength and flux
+    """
+    with open(file_name) as asc:
+        header = [asc.readline(), asc.readline()]
+        body = asc.read()
+    if not header[0].startswith('the number of points per synthesis'):
+        raise ValueError('%s is not a MOOG smoothed spectrum: %s' % (file_name, header[0].strip()))
+    npoints = int(header[0].split('=')[1])
+    start, stop, step = [float(value) for value in re.findall(r'=\s*(\S+)', header[1])]
+
+    try:
+        synth = np.array(body.split(), dtype=float).reshape(-1, 2)
+    except ValueError:
+        synth = None
+    if synth is None or len(synth) != npoints:
+        # columns written by MOOG with format (f10.3,f12.5) can touch each other (e.g. wavelengths above 10000 A)
+        data_lines = ''.join(line for line in body.splitlines(True) if line[:1] == ' ')
+        synth = np.genfromtxt(io.StringIO(data_lines), delimiter=(10, 12)).reshape(-1, 2)
+    if len(synth) != npoints or abs(synth[0, 0] - start) > step/2.:
+        raise ValueError('%s: expected %d points from %s, found %d from %s' % (file_name, npoints, start, len(synth),
+                                                                                synth[0, 0] if len(synth) else None))
+    return synth[:, 0], synth[:, 1]
+
+
+def read_moog_summary(file_name):
+    """
+    Reads the unsmoothed synthetic spectrum from the MOOG summary_out file (line depths written with format 10f7.4,
+    after the line with start, stop and step of the synthesis). The number of points is validated against start, stop
+    and step.
+    :param file_name: string, path of the summary_out file
+    :return: arrays of wavelength and flux
+    """
+    with open(file_name) as summary:
+        lines = summary.read().splitlines()
+    first = [i for i, line in enumerate(lines) if line.startswith('MODEL:')][0] + 1
+    start, stop, step = [float(value) for value in lines[first].split()[:3]]
+    npoints = int(round((stop - start)/step)) + 1
+
+    try:
+        depth = np.array(' '.join(lines[first+1:]).split(), dtype=float)
+    except ValueError:
+        depth = None
+    if depth is None or len(depth) != npoints:
+        # negative depths close to zero touch the previous value (e.g. 0.0000-0.0000), read fields of 7 characters
+        depth = np.array([line[i:i+7] for line in lines[first+1:] for i in range(0, len(line.rstrip()), 7)],
+                         dtype=float)
+    if len(depth) != npoints:
+        raise ValueError('%s: expected %d points from %s to %s, found %d' % (file_name, npoints, start, stop,
+                                                                             len(depth)))
+    synth_lambda = np.round(start + step*np.arange(len(depth)), 3)
+    return synth_lambda, 1.0 - depth
+
+
+def synthesize(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad, run_dir=RUN_PATH, cache=SYNTH_CACHE,
+               smooth=True):
+    """
+    Returns the MOOG synthetic spectrum for the given inputs, running MOOG only when the same synthesis is not
+    already in the cache.
+    :param star: string, star (the atmosphere model run_dir+star.atm must exist)
+    :param p: list of floats, parameters (in this case, only vrot)
+    :param vmac: float, macroturbulence
+    :param lambda_i: float, starting wavelength of synthesis
+    :param lambda_f: float, ending wavelength of synthesis
+    :param ldc: float, limb darkening coefficient
+    :param CDELT1: float, delta lambda in the observed spectrum
+    :param instr_broad: float, instrumental broadening
+    :param run_dir: string, working directory of MOOG
+    :param cache: SynthesisCache or None to always run MOOG
+    :param smooth: bool, if False returns the unbroadened synthesis (see moog_fe)
+    :return: arrays of wavelength and flux of the synthetic spectrum
+    """
+    if cache is not None:
+        # MOOG only sees the values as they are written in the .par file
+        if smooth:
+            key = cache.key(run_dir + star + '.atm', lambda_i, lambda_f, round(CDELT1, 3), round(instr_broad, 3),
+                            round(p[0], 3), round(ldc, 3), round(vmac, 3))
+        else:
+            key = cache.key(run_dir + star + '.atm', lambda_i, lambda_f, round(CDELT1, 3), 'unsmoothed')
+        synth = cache.get(key)
+        if synth is not None:
+            return synth
+
+    moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad, run_dir=run_dir, smooth=smooth)
+    if smooth:
+        synth_lambda, synth_data = read_moog_asc(run_dir+'synth_fe.asc')
+    else:
+        synth_lambda, synth_data = read_moog_summary(run_dir+'out1')
+
+    if cache is not None:
+        cache.put(key, synth_lambda, synth_data)
+    return synth_lambda, synth_data
+
+
+def rotational_kernel(dv, vrot, ldc):
+    """
+    Rotational broadening profile (Gray) with linear limb darkening, integrated over each velocity bin so that it is
+    exactly normalised for any vrot.
+    :param dv: float, velocity step of the grid in km/s
+    :param vrot: float, vsini in km/s
+    :param ldc: float, limb darkening coefficient
+    :return: array, kernel with an odd number of points centred on zero velocity
+    """
+    if vrot <= 0:
+        return np.ones(1)
+    n = int(np.ceil(vrot/dv - 0.5))
+    v = np.arange(-n, n+1)*dv
+    u_lo = np.clip((v - dv/2.)/vrot, -1., 1.)
+    u_hi = np.clip((v + dv/2.)/vrot, -1., 1.)
+
+    def primitive(u):
+        return (1.-ldc)*(u*np.sqrt(1.-u**2) + np.arcsin(u)) + np.pi*ldc/2.*(u - u**3/3.)
+
+    return (primitive(u_hi) - primitive(u_lo))/(np.pi*(1.-ldc/3.))
+
+
+def rotational_kernel_derivative(dv, vrot, ldc):
+    """
+    Derivative with respect to vrot of rotational_kernel, on the same velocity bins.
+    :param dv: float, velocity step of the grid in km/s
+    :param vrot: float, vsini in km/s
+    :param ldc: float, limb darkening coefficient
+    :return: array, derivative of the kernel in 1/(km/s)
+    """
+    if vrot <= 0:
+        return np.zeros(1)
+    n = int(np.ceil(vrot/dv - 0.5))
+    v = np.arange(-n, n+1)*dv
+    u_lo = np.clip((v - dv/2.)/vrot, -1., 1.)
+    u_hi = np.clip((v + dv/2.)/vrot, -1., 1.)
+
+    def profile(u):
+        # derivative of the primitive of rotational_kernel, zero at the limb (u = +-1)
+        return 2.*(1.-ldc)*np.sqrt(1.-u**2) + np.pi*ldc/2.*(1.-u**2)
+
+    # du/dvrot = -u/vrot
+    return (profile(u_lo)*u_lo - profile(u_hi)*u_hi)/(vrot*np.pi*(1.-ldc/3.))
+
+
+def macroturbulence_kernel(dv, vmac):
+    """
+    Radial-tangential macroturbulence profile (Gray) with equal radial and tangential components.
+    :param dv: float, velocity step of the grid in km/s
+    :param vmac: float, macroturbulence in km/s
+    :return: array, normalised kernel centred on zero velocity
+    """
+    n = int(np.ceil(5*vmac/dv)) if vmac > 0 else 0
+    if n == 0:
+        return np.ones(1)
+    x = np.abs(np.arange(-n, n+1)*dv)/vmac
+    kernel = np.exp(-x**2) - np.sqrt(np.pi)*x*erfc(x)
+    return kernel/np.sum(kernel)
+
+
+def gaussian_kernel(dv, fwhm):
+    """
+    :param dv: float, velocity step of the grid in km/s
+    :param fwhm: float, full width at half maximum in km/s
+    :return: array, normalised gaussian kernel centred on zero velocity
+    """
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))
+    n = int(np.ceil(4*sigma/dv)) if fwhm > 0 else 0
+    if n == 0:
+        return np.ones(1)
+    kernel = np.exp(-0.5*(np.arange(-n, n+1)*dv/sigma)**2)
+    return kernel/np.sum(kernel)
+
+
+def broaden_spectrum(synth_lambda, synth_data, vrot, vmac, ldc, instr_broad):
+    """
+    Applies the rotational, macroturbulence and instrumental broadening to an unsmoothed synthetic spectrum (the same
+    broadenings of the 'r' smoothing of MOOG).
+    :param synth_lambda: array, wavelength of the unsmoothed synthesis (uniform step)
+    :param synth_data: array, flux of the unsmoothed synthesis
+    :param vrot: float, vsini in km/s
+    :param vmac: float, macroturbulence in km/s
+    :param ldc: float, limb darkening coefficient
+    :param instr_broad: float, FWHM of the instrumental profile in Angstrom
+    :return: array, broadened flux at synth_lambda
+    """
+    return broaden_spectrum_grid(synth_lambda, synth_data, [vrot], vmac, ldc, instr_broad)[0]
+
+
+def broaden_spectrum_derivative(synth_lambda, synth_data, vrot, vmac, ldc, instr_broad):
+    """
+    Derivative with respect to vrot of broaden_spectrum, from the convolution of the line depths with the derivative of
+    the rotational kernel.
+    :return: array, derivative of the broadened flux at synth_lambda in 1/(km/s)
+    """
+    # broaden_spectrum_grid returns 1 - depth*kernel, the derivative is -depth*(d kernel/d vrot)
+    return broaden_spectrum_grid(synth_lambda, synth_data, [vrot], vmac, ldc, instr_broad,
+                                 kernel_function=rotational_kernel_derivative)[0] - 1.
+
+
+def broaden_spectrum_grid(synth_lambda, synth_data, vrot_values, vmac, ldc, instr_broad, select=None, block=32,
+                          kernel_function=rotational_kernel):
+    """
+    Same as broaden_spectrum for a whole vector of vsini values at once. As in the MOOG smoothing, the velocity kernels
+    are converted to wavelength at the middle of the synthesis, and the line depths are convolved with all the kernels
+    with one FFT of the spectrum.
+    :param synth_lambda: array, wavelength of the unsmoothed synthesis (uniform step)
+    :param synth_data: array, flux of the unsmoothed synthesis
+    :param vrot_values: array, vsini values in km/s
+    :param vmac: float, macroturbulence in km/s
+    :param ldc: float, limb darkening coefficient
+    :param instr_broad: float, FWHM of the instrumental profile in Angstrom
+    :param select: array of indices of synth_lambda to return (default: all)
+    :param block: int, number of vsini values convolved together (limits the memory used)
+    :param kernel_function: function (dv, vrot, ldc) giving the rotational kernel
+    :return: array (len(vrot_values), len(select)) of broadened fluxes
+    """
+    if select is None:
+        select = np.arange(len(synth_lambda))
+    depth = 1. - np.asarray(synth_data)
+    lambda_mid = (synth_lambda[0] + synth_lambda[-1])/2.
+    dv = LIGHT_SPEED*(synth_lambda[1] - synth_lambda[0])/lambda_mid
+    instr_fwhm = LIGHT_SPEED*instr_broad/lambda_mid
+    other_kernel = np.convolve(macroturbulence_kernel(dv, vmac), gaussian_kernel(dv, instr_fwhm))
+    kernels = [np.convolve(kernel_function(dv, vrot, ldc), other_kernel) for vrot in vrot_values]
+    half = max(len(kernel) for kernel in kernels)//2
+
+    nfft = next_fast_len(len(depth) + 2*half)
+    depth_fft = rfft(depth, nfft)
+    flux = np.empty((len(kernels), len(select)))
+    for start in range(0, len(kernels), block):
+        kernel_block = np.zeros((len(kernels[start:start+block]), 2*half + 1))
+        for i, kernel in enumerate(kernels[start:start+block]):
+            pad = half - len(kernel)//2
+            kernel_block[i, pad:pad+len(kernel)] = kernel
+        conv = irfft(depth_fft*rfft(kernel_block, nfft, axis=1), nfft, axis=1)[:, half:half+len(depth)]
+        flux[start:start+block] = 1. - conv[:, select]
+    return flux
+
+
+class IntervalIndex:
+    """
+    Positions of the intervals of vsini_intervals.list in a wavelength array, found once with np.searchsorted. The
+    points of all the intervals are then taken with one gather, instead of one np.where over the whole array for each
+    interval.
+    """
+
+    def __init__(self, ll, fe_intervals, columns=('ll_si', 'll_sf')):
+        """
+        :param ll: array, wavelength (not necessarily sorted, e.g. several syntheses one after the other)
+        :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+        :param columns: names of the columns with the first and last wavelength of the intervals (both included)
+        """
+        self.ll = np.asarray(ll)
+        lower, upper = fe_intervals[list(columns)].to_numpy(dtype=float).T
+        order = np.argsort(self.ll, kind='stable')
+        self.starts = np.searchsorted(self.ll[order], lower, side='left')
+        self.stops = np.searchsorted(self.ll[order], upper, side='right')
+        # indices of the points of each interval in increasing order, as np.where gives them
+        self.segments = [np.sort(order[start:stop]) for start, stop in zip(self.starts, self.stops)]
+        self.indices = np.concatenate(self.segments)
+
+    def matches(self, ll):
+        """
+        :param ll: array, wavelength
+        :return: bool, True if the index was built for this wavelength array
+        """
+        return len(ll) == len(self.ll) and np.array_equal(ll, self.ll)
+
+    def take(self, values):
+        """
+        :param values: array (..., number of wavelength points), e.g. a flux or a stack of fluxes
+        :return: array (..., number of points in the intervals), values inside the intervals in the order of the
+                 intervals
+        """
+        return np.asarray(values)[..., self.indices]
+
+    def split(self, values):
+        """
+        :param values: array (..., number of wavelength points)
+        :return: list of arrays, values inside each interval
+        """
+        values = np.asarray(values)
+        return [values[..., segment] for segment in self.segments]
+
+
+def broaden_intervals(raw_synth, vrot_values, vmac, ldc, instr_broad, index):
+    """
+    broaden_spectrum_grid of all the chunks of the unsmoothed synthesis, keeping only the points inside the intervals,
+    so that the fluxes of the whole chunks are never stored for all the vsini values.
+    :param raw_synth: list of tuples from raw_synthesis
+    :param vrot_values: array, vsini values in km/s
+    :param index: IntervalIndex of the intervals in the wavelength of all the chunks one after the other
+    :return: array (len(vrot_values), len(index.indices)) of broadened fluxes, in the order of index.take
+    """
+    # points inside any interval, in the order of the chunks
+    needed = np.unique(index.indices)
+    flux = []
+    offset = 0
+    for synth_lambda_chunk, synth_data_chunk in raw_synth:
+        select = needed[(needed >= offset) & (needed < offset + len(synth_lambda_chunk))] - offset
+        if len(select) > 0:
+            flux.append(broaden_spectrum_grid(synth_lambda_chunk, synth_data_chunk, vrot_values, vmac, ldc,
+                                              instr_broad, select=select))
+        offset += len(synth_lambda_chunk)
+    return np.concatenate(flux, axis=1)[:, np.searchsorted(needed, index.indices)]
+
+
+def grid_search(raw_synth, vmac, fe_intervals, obs_flux, ldc, instr_broad, limits, flux_err=0.01, coarse_step=0.25,
+                fine_step=0.01):
+    """
+    Finds vsini by evaluating the chi-square for a whole grid of values in one batched broadening of the unsmoothed
+    synthesis, then refining around the minimum with a finer grid and a parabola.
+    :param raw_synth: list of tuples from raw_synthesis
+    :param vmac: float, macroturbulence of star
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :param obs_flux: array of observational flux points
+    :param ldc: float, limb darkening coefficient
+    :param instr_broad: float, instrumental broadening
+    :param limits: list, lower and upper values of vsini
+    :param flux_err: float, error in observational flux points
+    :param coarse_step: float, step in km/s of the first grid
+    :param fine_step: float, step in km/s of the refined grid
+    :return: best vsini, its error, and arrays of vsini and chi-square of all the evaluated points
+    """
+    index = IntervalIndex(np.concatenate([chunk[0] for chunk in raw_synth]), fe_intervals)
+    obs_flux = np.asarray(obs_flux)
+
+    def chi2(vrot_values):
+        flux = broaden_intervals(raw_synth, vrot_values, vmac, ldc, instr_broad, index)
+        return np.sum(((obs_flux - flux)/flux_err)**2, axis=1)
+
+    vrot_coarse = np.append(np.arange(limits[0], limits[1], coarse_step), limits[1])
+    chi2_coarse = chi2(vrot_coarse)
+    best = vrot_coarse[np.argmin(chi2_coarse)]
+
+    vrot_fine = np.arange(max(limits[0], best - 2*coarse_step), min(limits[1], best + 2*coarse_step) + fine_step/2.,
+                          fine_step)
+    chi2_fine = chi2(vrot_fine)
+    i_min = np.argmin(chi2_fine)
+
+    # parabola around the minimum: vertex for the best value and curvature for the error (delta chi-square = 1)
+    near = np.abs(vrot_fine - vrot_fine[i_min]) <= 10*fine_step
+    a, b, c = np.polyfit(vrot_fine[near], chi2_fine[near], 2)
+    if a > 0 and 0 < i_min < len(vrot_fine) - 1:
+        vrot = float(np.clip(-b/(2*a), limits[0], limits[1]))
+    else:
+        print('grid search: minimum of the chi-square at the limit of the vsini grid')
+        vrot = float(vrot_fine[i_min])
+    vrot_err = float(1./np.sqrt(a)) if a > 0 else 0.0
+
+    vrot_grid = np.concatenate((vrot_coarse, vrot_fine))
+    chi2_grid = np.concatenate((chi2_coarse, chi2_fine))
+    order = np.argsort(vrot_grid, kind='stable')
+    return vrot, vrot_err, vrot_grid[order], chi2_grid[order]
+
+
+def rotational_fwhm(ldc):
+    """
+    :return: float, full width at half maximum of the rotational profile in units of vsini
+    """
+    x = np.linspace(0., 1., 10001)
+    profile = 2.*(1.-ldc)*np.sqrt(1.-x**2) + np.pi*ldc/2.*(1.-x**2)
+    return 2.*np.interp(-profile[0]/2., -profile, x)
+
+
+def line_fwhm(synth_lambda, synth_data, fe_intervals, smooth=1):
+    """
+    Width at half depth of the deepest line inside each interval [ll_si, ll_sf]. The half depth is searched from the
+    line centre outwards, stopping where the depth grows again (a blend).
+    :param smooth: int, number of points of the running mean applied to the depth of each interval, so that the noise
+                   of observed lines does not stop the search before the half depth (1: no smoothing)
+    :return: array with one width per interval in km/s (nan where the interval has no line)
+    """
+    widths = []
+    for ll_si, ll_sf in fe_intervals[['ll_si', 'll_sf']].to_numpy():
+        select = (synth_lambda >= ll_si) & (synth_lambda <= ll_sf)
+        lambda_interval = np.asarray(synth_lambda)[select]
+        depth = 1. - np.asarray(synth_data)[select]
+        if smooth > 1 and len(depth) >= smooth:
+            depth = np.convolve(depth, np.ones(smooth)/smooth, mode='same')
+        if len(depth) < 3 or np.max(depth) <= 0:
+            widths.append(np.nan)
+            continue
+        center = np.argmax(depth)
+        half = depth[center]/2.
+        edges = []
+        for direction in [-1, 1]:
+            i = center
+            while 0 <= i + direction < len(depth) and depth[i + direction] > half and \
+                    depth[i + direction] <= depth[i]:
+                i += direction
+            j = i + direction
+            if not 0 <= j < len(depth) or depth[j] > half:
+                edges.append(lambda_interval[i])
+            else:
+                # linear interpolation between the last point above and the first point below half depth
+                edges.append(lambda_interval[i] + (lambda_interval[j] - lambda_interval[i]) *
+                             (depth[i] - half)/(depth[i] - depth[j]))
+        widths.append((edges[1] - edges[0])*LIGHT_SPEED/lambda_interval[center])
+    return np.array(widths)
+
+
+def estimate_vsini_width(obs_lambda, obs_flux, fe_intervals, vmac, ldc, instr_broad, raw_synth):
+    """
+    Quick vsini from the widths of the observed lines: the rotational width is taken as the quadratic difference
+    between the width of the observed lines and the width of the unsmoothed synthesis broadened without rotation.
+    Both are measured after a running mean of LINE_WIDTH_SMOOTH points.
+    :param raw_synth: list of unsmoothed syntheses from raw_synthesis
+    :return: float, vsini in km/s inside VSINI_LIMITS, or None if the lines are not wider than without rotation
+    """
+    obs_width = line_fwhm(np.asarray(obs_lambda), np.asarray(obs_flux), fe_intervals, smooth=LINE_WIDTH_SMOOTH)
+    synth_lambda = np.concatenate([synth_lambda_chunk for synth_lambda_chunk, synth_data_chunk in raw_synth])
+    synth_data = np.concatenate([broaden_spectrum(synth_lambda_chunk, synth_data_chunk, 0., vmac, ldc, instr_broad)
+                                 for synth_lambda_chunk, synth_data_chunk in raw_synth])
+    rest_width = line_fwhm(synth_lambda, synth_data, fe_intervals, smooth=LINE_WIDTH_SMOOTH)
+    rotation_width2 = np.nanmedian(obs_width**2 - rest_width**2)
+    if not np.isfinite(rotation_width2) or rotation_width2 <= 0:
+        return None
+    vsini = np.sqrt(rotation_width2)/rotational_fwhm(ldc)
+    return float(np.clip(vsini, VSINI_LIMITS[0], VSINI_LIMITS[1]))
+
+
+def synthesis_limits(obs_lambda):
+    """
+    Splits the wavelength range of the observed points in 1 to 3 syntheses of up to about 450 Angstrom.
+    :param obs_lambda: array, wavelength of the observed points
+    :return: lists of the starting and ending wavelengths of the syntheses
+    """
+    gap = obs_lambda[-1] - obs_lambda[0]
+    if gap <= 450:
+        lambda_i_values = [round(obs_lambda[0], 3)]
+        lambda_f_values = [round(obs_lambda[-1], 3)]
+    elif gap > 450 and gap <= 900:
+        lambda_i_values = [round(obs_lambda[0], 3), round(obs_lambda[int(len(obs_lambda)/2)], 3)]
+        lambda_f_values = [round(obs_lambda[int(len(obs_lambda)/2)-1], 3), round(obs_lambda[-1], 3)]
+    elif gap > 900:
+        lambda_i_values = [round(obs_lambda[0], 3), round(obs_lambda[int(len(obs_lambda)/3)], 3), round(obs_lambda[int(len(obs_lambda)/3*2)], 3)]
+        lambda_f_values = [round(obs_lambda[int(len(obs_lambda)/3)-1], 3), round(obs_lambda[int(len(obs_lambda)/3*2)-1], 3), round(obs_lambda[-1], 3)]
+    return lambda_i_values, lambda_f_values
+
+
+def synthesis_windows(obs_lambda, fe_intervals, CDELT1, vmac, instr_broad):
+    """
+    Wavelength ranges around each small interval (ll_si to ll_sf) with a margin that covers the largest broadening
+    of the fit. The ranges start on the wavelength grid of the observed points and overlapping ranges are merged.
+    :param obs_lambda: array, wavelength of the observed points
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :param CDELT1: float, delta lambda in the observed spectrum
+    :param vmac: float, macroturbulence of star
+    :param instr_broad: float, instrumental broadening
+    :return: lists of the starting and ending wavelengths of the syntheses
+    """
+    step = round(CDELT1, 3)
+    lambda_i_values = []
+    lambda_f_values = []
+    for ll_si, ll_sf in sorted(fe_intervals[['ll_si', 'll_sf']].to_numpy().tolist()):
+        margin = ll_sf*(VSINI_LIMITS[1] + 5*vmac)/LIGHT_SPEED + 2*instr_broad
+        lambda_i = round(obs_lambda[0] + np.floor((ll_si - margin - obs_lambda[0])/step)*step, 3)
+        lambda_f = round(obs_lambda[0] + np.ceil((ll_sf + margin - obs_lambda[0])/step)*step, 3)
+        if lambda_i_values and lambda_i <= lambda_f_values[-1] + step:
+            lambda_f_values[-1] = max(lambda_f_values[-1], lambda_f)
+        else:
+            lambda_i_values.append(lambda_i)
+            lambda_f_values.append(lambda_f)
+    return lambda_i_values, lambda_f_values
+
+
+def synthesis_ranges(obs_lambda, fe_intervals, CDELT1, vmac, instr_broad, windows=False):
+    """
+    :param windows: bool, if True synthesize only the windows around the line intervals (synthesis_windows),
+                    otherwise the whole range of the observed points in chunks of up to 450 Angstrom (synthesis_limits)
+    :return: list of tuples (lambda_i, lambda_f) of the MOOG syntheses
+    """
+    if windows:
+        return list(zip(*synthesis_windows(obs_lambda, fe_intervals, CDELT1, vmac, instr_broad)))
+    return list(zip(*synthesis_limits(obs_lambda)))
+
+
+def raw_synthesis(star, synth_ranges, CDELT1, run_dir=RUN_PATH):
+    """
+    Unsmoothed MOOG synthesis of the given ranges, computed once per atmosphere model and broadened later with
+    broaden_spectrum.
+    :param synth_ranges: list of tuples (lambda_i, lambda_f) from synthesis_ranges
+    :return: list of tuples (wavelength, flux), one per synthesis
+    """
+    raw_synth = []
+    for lambda_i, lambda_f in synth_ranges:
+        raw_synth.append(synthesize(star, [0.0], 0.0, lambda_i, lambda_f, 0.0, CDELT1, 0.0, run_dir=run_dir,
+                                    smooth=False))
+    return raw_synth
+
+
+def synth_spectrum(p, star, vmac, synth_ranges, ldc, CDELT1, instr_broad, run_dir=RUN_PATH, raw_synth=None):
+    """
+    Synthetic spectrum of the given ranges, either smoothed by MOOG or, if raw_synth is given, broadened in NumPy from
+    the unsmoothed synthesis.
+    :param synth_ranges: list of tuples (lambda_i, lambda_f) from synthesis_ranges
+    :param raw_synth: list of tuples from raw_synthesis or None to run the MOOG smoothing
+    :return: arrays of wavelength and flux of the synthetic spectrum
+    """
+    synth_data = []  # all flux values from model
+    synth_lambda = []  # all wavelength points from model
+
+    if raw_synth is None:
+        for lambda_i, lambda_f in synth_ranges:
+            synth_lambda_chunk, synth_data_chunk = synthesize(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1,
+                                                              instr_broad, run_dir=run_dir)
+            synth_lambda.append(synth_lambda_chunk)
+            synth_data.append(synth_data_chunk)
+    else:
+        for synth_lambda_chunk, synth_data_chunk in raw_synth:
+            synth_lambda.append(synth_lambda_chunk)
+            synth_data.append(broaden_spectrum(synth_lambda_chunk, synth_data_chunk, p[0], vmac, ldc, instr_broad))
+
+    return np.concatenate(synth_lambda), np.concatenate(synth_data)
+
+
+def synth_spectrum_derivative(p, vmac, ldc, instr_broad, raw_synth):
+    """
+    Derivative with respect to vsini of the synthetic spectrum, from the NumPy broadening of the unsmoothed synthesis.
+    :param raw_synth: list of tuples from raw_synthesis
+    :return: array, derivative of the flux at the wavelengths of synth_spectrum
+    """
+    return np.concatenate([broaden_spectrum_derivative(synth_lambda_chunk, synth_data_chunk, p[0], vmac, ldc,
+                                                       instr_broad)
+                           for synth_lambda_chunk, synth_data_chunk in raw_synth])
+
+
+def fit_mpfit(myfunct, fa, vrot_info, tolerances, maxiter, derivative, multifunct=None, executor=None):
+    """
+    Levenberg-Marquardt fit of vsini with mpfit.
+    :param myfunct: function (p, fjac=None, **fa) returning [status, deviates] or, if fjac is given, [status,
+                    deviates, derivatives of the model]
+    :param fa: dictionary, keyword arguments of myfunct
+    :param vrot_info: dictionary, parinfo of vsini (starting value and limits)
+    :param tolerances: dictionary, ftol, xtol and gtol of mpfit
+    :param maxiter: int, maximum number of iterations
+    :param derivative: string, 'analytic' or 'numeric'
+    :param multifunct: function (ps, fjac=None, **fa) returning [status, deviates] for a stack of parameter vectors,
+                       used by mpfit for the finite differences (None to call myfunct for each of them)
+    :param executor: concurrent.futures.Executor that evaluates the finite differences of mpfit at the same time (None
+                     to evaluate them one after the other)
+    :return: mpfit object (params, perror, niter, fnorm, status)
+    """
+    return mpfit(myfunct, parinfo=[vrot_info], functkw=fa, maxiter=maxiter,
+                 autoderivative=int(derivative != 'analytic'), multifcn=multifunct, executor=executor, **tolerances)
+
 
-    os.system('rm '+RUN_PATH+'batch.par')
-    os.system('cd '+RUN_PATH+' && '+MOOG_PATH+'MOOGSILENT < synth_fe.txt')
+def vsini_jacobian(myfunct, fa, vrot, vrot_info):
+    """
+    Derivative of the deviates in vsini from differences at +-vrot_info['step'] (the step of mpfit, not smaller than
+    the rounding of vsini in the .par file), one sided at the limits.
+    :return: array with one column, derivative of the deviates
+    """
+    lower, upper = vrot_info['limits']
+    vrot_low = max(vrot - vrot_info['step'], lower)
+    vrot_high = min(vrot + vrot_info['step'], upper)
+    return ((myfunct([vrot_high], **fa)[1] - myfunct([vrot_low], **fa)[1])/(vrot_high - vrot_low))[:, None]
 
-    return 'Finished MOOG synthesis for ' + star + ' in range ' + str(lambda_i) + ' to ' + str(lambda_f) + '.'
 
-def minimize_synth(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT1, instr_broad, **kwargs):
+def fit_brent(myfunct, fa, vrot_info, tolerances, maxiter, derivative, multifunct=None, executor=None):
+    """
+    Brent (golden section and parabolic interpolation) minimization of the chi-square in vsini, started from
+    vrot_info['value']: the minimum is bracketed by walking downhill from the starting vsini inside the limits, with
+    steps growing from max(10% of the start, 0.5 km/s). If the chi-square keeps decreasing up to a limit, the bounded
+    Brent method is used between the limit and the last point. The error comes from the curvature of the chi-square at
+    the minimum, 2*sum(J**2) with the derivative J of the deviates (vsini_jacobian for the numeric derivative).
+    Same parameters and result attributes as fit_mpfit (multifunct and executor are not used). xtol is relative, as in
+    mpfit.
+    """
+    def chi2(vrot):
+        return float(np.sum(myfunct([vrot], **fa)[1]**2))
+
+    lower, upper = vrot_info['limits']
+    b = min(max(vrot_info['value'], lower), upper)
+    step = max(0.1*abs(b), 0.5)
+    a = max(lower, b - step)
+    c = min(upper, b + step)
+    chi2_a, chi2_b, chi2_c = chi2(a), chi2(b), chi2(c)
+    while True:
+        step *= 1.618
+        if chi2_a < chi2_b and a > lower:
+            b, c, chi2_b, chi2_c = a, b, chi2_a, chi2_b
+            a = max(lower, b - step)
+            chi2_a = chi2(a)
+        elif chi2_c < chi2_b and c < upper:
+            a, b, chi2_a, chi2_b = b, c, chi2_b, chi2_c
+            c = min(upper, b + step)
+            chi2_c = chi2(c)
+        else:
+            break
+
+    # maxiter counts the iterations of mpfit, which need a few evaluations each
+    if chi2_b < chi2_a and chi2_b < chi2_c:
+        res = minimize_scalar(chi2, bracket=(a, b, c), method='brent',
+                              options={'xtol': tolerances['xtol'], 'maxiter': 5*maxiter})
+    else:
+        # the minimum is at a limit
+        res = minimize_scalar(chi2, bounds=(a, c), method='bounded',
+                              options={'xatol': tolerances['xtol']*max(abs(b), 1.), 'maxiter': 5*maxiter})
+    vrot = float(res.x)
+    if derivative == 'analytic':
+        jacobian = myfunct([vrot], fjac=[1], **fa)[2]
+    else:
+        jacobian = vsini_jacobian(myfunct, fa, vrot, vrot_info)
+    # Gauss-Newton curvature, a second difference of the chi-square would mostly see the rounding of the fluxes
+    curvature = 2.*np.sum(jacobian**2)
+    vrot_err = np.sqrt(2./curvature) if curvature > 0 else np.nan
+    return SimpleNamespace(params=np.array([vrot]), perror=np.array([vrot_err]), niter=res.nit, fnorm=float(res.fun),
+                           status=2 if res.success else 5)
+
+
+def fit_least_squares(myfunct, fa, vrot_info, tolerances, maxiter, derivative, multifunct=None, executor=None):
+    """
+    Trust region reflective fit of vsini with scipy.optimize.least_squares. The numeric derivative is vsini_jacobian,
+    the relative steps of least_squares are below the rounding of vsini for small values.
+    Same parameters and result attributes as fit_mpfit (multifunct and executor are not used). xtol is relative to
+    vsini, as in mpfit.
+    """
+    def residuals(p):
+        return myfunct(p, **fa)[1]
+
+    def jacobian(p):
+        if derivative != 'analytic':
+            return vsini_jacobian(myfunct, fa, p[0], vrot_info)
+        # mpfit derivatives are of the model, the deviates are (data - model)/err
+        return -myfunct(p, fjac=[1], **fa)[2]
+
+    # the trust region reflective method needs a start strictly inside the limits
+    lower, upper = vrot_info['limits']
+    vrot_start = np.clip(vrot_info['value'], lower + 1e-6*(upper - lower), upper - 1e-6*(upper - lower))
+    res = least_squares(residuals, [vrot_start], jac=jacobian, bounds=vrot_info['limits'], method='trf',
+                        ftol=tolerances['ftol'], xtol=tolerances['xtol'], gtol=tolerances['gtol'], max_nfev=5*maxiter)
+    curvature = np.sum(res.jac**2)
+    vrot_err = 1./np.sqrt(curvature) if curvature > 0 else np.nan
+    # least_squares status codes as the mpfit ones (convergence_info): gtol, ftol, xtol, ftol and xtol, max evaluations
+    status = {1: 4, 2: 1, 3: 2, 4: 3, 0: 5}.get(res.status, res.status)
+    return SimpleNamespace(params=res.x, perror=np.array([vrot_err]), niter=res.nfev, fnorm=float(2*res.cost),
+                           status=status)
+
+
+OPTIMIZERS = {'mpfit': fit_mpfit, 'brent': fit_brent, 'least_squares': fit_least_squares}
+
+
+def minimize_synth(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT1, instr_broad, run_dir=RUN_PATH,
+                   synth_mode='moog', method='mpfit', chi2_curve_file=None, windows=False, derivative='auto',
+                   start='auto', vrot_limits=None, vsini_tol=None, maxiter=20, jacobian_workers=1, **kwargs):
     """
     Function to minimize a model to observational data.
     :param p: list, initial values of parameters
@@ -115,13 +1026,50 @@ def minimize_synth(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT
     :param obs_flux: list of observational flux points
     :param ldc: float, limb darkening coefficient
     :param CDELT1: float, delta lambda in the observed spectrum
+    :param run_dir: string, working directory of MOOG for this fit
+    :param synth_mode: string, 'moog' to run the MOOG synthesis and smoothing at every evaluation, 'broaden' to run
+                       MOOG once without smoothing and apply the broadening in NumPy at every evaluation
+    :param method: string, a backend of OPTIMIZERS ('mpfit' for the Levenberg-Marquardt fit, 'brent' for the bounded
+                   Brent minimization of the chi-square, 'least_squares' for scipy.optimize.least_squares) or 'grid'
+                   for a batched chi-square scan of vsini (the grid always uses the NumPy broadening of one unsmoothed
+                   MOOG synthesis)
+    :param chi2_curve_file: string, file where the chi-square curve of the grid is saved (method 'grid' only)
+    :param windows: bool, synthesize only windows around the line intervals instead of the whole range
+    :param derivative: string, 'analytic' to give mpfit the derivative of the model from the derivative of the
+                       rotational kernel (one synthesis per iteration), 'numeric' for the finite differences of mpfit
+                       (three syntheses per iteration), 'auto' for 'analytic' in synth_mode 'broaden' and 'numeric' in
+                       synth_mode 'moog' (the analytic derivative is the one of the NumPy broadening, not of the MOOG
+                       smoothing used by the model)
+    :param start: string, starting vsini of mpfit: 'auto' for the value of Literature_values.txt or, when the star is
+                  not there, the estimate from the widths of the lines; 'width' for the estimate from the widths;
+                  'fixed' for p[0]
+    :param vrot_limits: list, limits of vsini in km/s (default: VSINI_LIMITS). If the mpfit result is at one of them,
+                        the fit continues inside VSINI_LIMITS
+    :param vsini_tol: float, change of vsini in km/s below which mpfit stops, instead of the relative tolerances
+                      ftol/xtol/gtol=1e-5
+    :param maxiter: int, maximum number of mpfit iterations (five times this number of evaluations for the other
+                    backends)
+    :param jacobian_workers: int, number of MOOG syntheses of the finite differences of mpfit run at the same time,
+                             each in its own sandbox inside run_dir (synth_mode 'moog' with numeric derivative)
     :param kwargs
-    :return: best values of parameters
+    :return: best values of parameters: vrot, vrot_err, iterations, chi-square, reduced chi-square, status and number
+             of evaluations of the model
     """
 
+    interval_index = []
 
-    def myfunct(p, star=None, vmac=None, fe_intervals=None, obs_lambda=None,
-                obs_flux=None, flux_err=0.01, **kwargs):
+    def synth_interval_index(synth_lambda, fe_intervals):
+        """
+        :return: IntervalIndex of the small intervals in the wavelength of the synthesis, built at the first evaluation
+                 and again only if the wavelength changes
+        """
+        if not interval_index or not interval_index[0].matches(synth_lambda):
+            interval_index[:] = [IntervalIndex(synth_lambda, fe_intervals)]
+        return interval_index[0]
+
+    def myfunct(p, fjac=None, star=None, vmac=None, fe_intervals=None, obs_lambda=None,
+                obs_flux=None, flux_err=0.01, run_dir=RUN_PATH, synth_ranges=None, raw_synth=None,
+                deriv_synth=None, **kwargs):
         """
         User supllied function that contains the model to be tested. Calculates the synthetic points at the same
         wavelength of the observational points (this means inside the iron lines regions).
@@ -134,8 +1082,12 @@ def minimize_synth(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT
         :param fe_lines_intervals: intervals where iron lines are present
         :param obs_flux: list of observational flux points
         :param flux_err: float, error in observational flux points (set to 0.01 here)
+        :param run_dir: string, working directory of MOOG for this fit
+        :param synth_ranges: list of tuples (lambda_i, lambda_f) of the MOOG syntheses
+        :param raw_synth: list of unsmoothed syntheses to be broadened (synth_mode 'broaden'), None to run MOOG
+        :param deriv_synth: list of unsmoothed syntheses used for the derivative when fjac is given
         :param kwargs
-        :return: integer (status of operations), array of deviates
+        :return: integer (status of operations), array of deviates and, if fjac is given, array of derivatives
         """
 
         #print round(p[0], 3)
@@ -143,46 +1095,37 @@ def minimize_synth(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT
         #lambda_i_values = [round(fe_intervals_lambda[0][0], 3), round(fe_intervals_lambda[0][0], 3) +2.01]
         #lambda_f_values = [round(fe_intervals_lambda[0][0], 3) + 2.00, round(fe_intervals_lambda[-1][1], 3)]
 
-        gap = obs_lambda[-1] - obs_lambda[0]
-        if gap <= 450:
-            lambda_i_values = [round(obs_lambda[0], 3)]
-            lambda_f_values = [round(obs_lambda[-1], 3)]
-        elif gap > 450 and gap <= 900:
-            lambda_i_values = [round(obs_lambda[0], 3), round(obs_lambda[int(len(obs_lambda)/2)], 3)]
-            lambda_f_values = [round(obs_lambda[int(len(obs_lambda)/2)-1], 3), round(obs_lambda[-1], 3)]
-        elif gap > 900:
-            lambda_i_values = [round(obs_lambda[0], 3), round(obs_lambda[int(len(obs_lambda)/3)], 3), round(obs_lambda[int(len(obs_lambda)/3*2)], 3)]
-            lambda_f_values = [round(obs_lambda[int(len(obs_lambda)/3)-1], 3), round(obs_lambda[int(len(obs_lambda)/3*2)-1], 3), round(obs_lambda[-1], 3)]
-
-        synth_data = []  # all flux values from model
-        synth_lambda = []  # all wavelength points from model
-
-        for lambda_i, lambda_f in zip(lambda_i_values, lambda_f_values):
-            moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad)
-            with open(RUN_PATH+'synth_fe.asc') as asc:
-                for x in asc:
-                    if x[0] == ' ':
-                        entry = x.rstrip().split()
-                        synth_lambda.append(float(entry[0]))
-                        synth_data.append(float(entry[1]))
-
-        synth_data_fe = []
-        synth_lambda_fe = []
-
-        fe_intervals_list = [row for row in fe_intervals[['ll_li', 'll_lf','ll_si','ll_sf']].to_numpy()]
-
-        for i,(ll_li, ll_lf, ll_si, ll_sf) in enumerate(fe_intervals_list):
-            select_sll = np.where((synth_lambda >= ll_si) & (synth_lambda <= ll_sf))[0]
-            synth_data_fe.extend(list(np.array(synth_data)[select_sll]))
-            synth_lambda_fe.extend(list(np.array(synth_lambda)[select_sll]))
+        synth_lambda, synth_data = synth_spectrum(p, star, vmac, synth_ranges, ldc, CDELT1, instr_broad,
+                                                  run_dir=run_dir, raw_synth=raw_synth)
+
+        index = synth_interval_index(synth_lambda, fe_intervals)
 
         obs_flux = np.array(obs_flux)
-        synth_data_fe = np.array(synth_data_fe)
+        synth_data_fe = index.take(synth_data)
 
         err = np.zeros(len(obs_flux)) + flux_err
         status = 0
 
-        return [status, (obs_flux - synth_data_fe)/err]
+        if fjac is None:
+            return [status, (obs_flux - synth_data_fe)/err]
+
+        # mpfit wants the derivative of the model (it changes the sign for the deviates) with one column per parameter
+        pderiv = index.take(synth_spectrum_derivative(p, vmac, ldc, instr_broad, deriv_synth))/err
+        return [status, (obs_flux - synth_data_fe)/err, pderiv.reshape(-1, 1)]
+
+    def multifunct(ps, fjac=None, vmac=None, fe_intervals=None, obs_flux=None, flux_err=0.01, raw_synth=None,
+                   **kwargs):
+        """
+        Same as myfunct for a stack of parameter vectors (one row per vsini), with one FFT broadening of the unsmoothed
+        synthesis for all of them (synth_mode 'broaden').
+        :param ps: array (number of vectors, 1) of vsini values
+        :return: integer (status of operations), array (number of vectors, number of points) of deviates
+        """
+        vrot_values = np.asarray(ps)[:, 0]
+        synth_lambda = np.concatenate([synth_lambda_chunk for synth_lambda_chunk, synth_data_chunk in raw_synth])
+        synth_data_fe = broaden_intervals(raw_synth, vrot_values, vmac, ldc, instr_broad,
+                                          synth_interval_index(synth_lambda, fe_intervals))
+        return [0, (np.array(obs_flux) - synth_data_fe)/flux_err]
 
     def convergence_info(res, parinfo, dof):
         """
@@ -234,83 +1177,416 @@ def minimize_synth(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT
     # define parameters for minimization
 #    vrot_info = {'parname': 'vrot', 'value': 15, 'fixed': 0, 'limited': [1, 1], 'limits': [1, 20], 'mpside': 2,
 #                    'step': 0.001}
-    vrot_info = {'parname': 'vrot', 'value': 5, 'fixed': 0, 'limited': [1, 1], 'limits': [0.1, 60], 'mpside': 2,
-                    'step': 0.001}
+    vrot_info = {'parname': 'vrot', 'value': p[0], 'fixed': 0, 'limited': [1, 1],
+                 'limits': list(vrot_limits or VSINI_LIMITS), 'mpside': 2, 'step': 0.001}
     parinfo = [vrot_info]
 
     fa = {'star': star, 'vmac': vmac, 'fe_intervals': fe_intervals, 'obs_lambda':
-            obs_lambda, 'obs_flux': obs_flux}
+            obs_lambda, 'obs_flux': obs_flux, 'run_dir': run_dir,
+          'synth_ranges': synthesis_ranges(obs_lambda, fe_intervals, CDELT1, vmac, instr_broad, windows=windows)}
+    if synth_mode == 'broaden' or method == 'grid':
+        fa['raw_synth'] = raw_synthesis(star, fa['synth_ranges'], CDELT1, run_dir=run_dir)
+    if derivative == 'auto':
+        derivative = 'analytic' if synth_mode == 'broaden' else 'numeric'
+    if derivative == 'analytic' and method != 'grid':
+        # with the MOOG smoothing, the derivative comes from the NumPy broadening of one unsmoothed synthesis
+        fa['deriv_synth'] = fa.get('raw_synth') or raw_synthesis(star, fa['synth_ranges'], CDELT1, run_dir=run_dir)
+
+    if method == 'grid':
+        vrot, vrot_err, vrot_grid, chi2_grid = grid_search(fa['raw_synth'], vmac, fe_intervals, obs_flux, ldc,
+                                                           instr_broad, vrot_info['limits'])
+        if chi2_curve_file is not None:
+            chi2_curve = pd.DataFrame(data=np.column_stack((vrot_grid, chi2_grid)), columns=['vrot', 'chi2'])
+            chi2_curve.to_csv(chi2_curve_file, index=False, sep='\t')
+        chi2_min = float(np.min(chi2_grid))
+        dof = len(obs_flux) - len(parinfo)
+        print (star, ('%s: %s +- %s' % (vrot_info['parname'], round(vrot, 3), round(vrot_err, 3))))
+        # same layout as convergence_info, with the number of evaluated grid points in place of the iterations
+        return [round(vrot, 3), round(vrot_err, 3), len(vrot_grid), round(chi2_min, 3), round(chi2_min/dof, 4), 1,
+                len(vrot_grid)]
+
+    vrot_start = literature_vsini(star) if start == 'auto' else None
+    if vrot_start is not None:
+        print(star, 'starting vrot from the literature:', vrot_start)
+    elif start in ['auto', 'width']:
+        raw_synth = fa.get('raw_synth') or fa.get('deriv_synth') or \
+            raw_synthesis(star, fa['synth_ranges'], CDELT1, run_dir=run_dir)
+        vrot_start = estimate_vsini_width(obs_lambda, obs_flux, fe_intervals, vmac, ldc, instr_broad, raw_synth)
+        if vrot_start is None:
+            print(star, 'no vrot from the line widths, starting from', vrot_info['value'])
+        else:
+            print(star, 'starting vrot from the line widths:', round(vrot_start, 3))
+    if vrot_start is not None:
+        vrot_info['value'] = vrot_start
+    vrot_info['value'] = float(np.clip(vrot_info['value'], vrot_info['limits'][0], vrot_info['limits'][1]))
+
+    if vsini_tol is None:
+        tolerances = {'ftol': 1e-5, 'xtol': 1e-5, 'gtol': 1e-5}
+    else:
+        # xtol is relative to vsini, the fit stops on the change of vsini only
+        tolerances = {'ftol': 1e-10, 'xtol': vsini_tol/max(vrot_info['value'], vsini_tol), 'gtol': 1e-10}
+
+    # every evaluation of the model (with or without derivative) is one synthesis, or one broadening
+    evaluations = []
+
+    def counted_funct(p, **kwargs):
+        evaluations.append(1)
+        return myfunct(p, **kwargs)
+
+    def counted_multifunct(ps, **kwargs):
+        evaluations.extend([1]*len(ps))
+        return multifunct(ps, **kwargs)
+
+    fit_thread = threading.get_ident()
+    thread_sandbox = threading.local()
+    thread_sandboxes = []
+
+    def sandboxed_funct(p, fjac=None, run_dir=None, **kwargs):
+        # the Jacobian threads run MOOG in their own sandboxes, with a copy of the atmosphere model
+        if threading.get_ident() != fit_thread:
+            if not hasattr(thread_sandbox, 'run_dir'):
+                thread_sandbox.run_dir = tempfile.mkdtemp(prefix='jacobian_', dir=run_dir) + '/'
+                shutil.copy(run_dir + '%s.atm' % star, thread_sandbox.run_dir)
+                thread_sandboxes.append(thread_sandbox.run_dir)
+            run_dir = thread_sandbox.run_dir
+        return counted_funct(p, fjac=fjac, run_dir=run_dir, **kwargs)
+
+    # the finite differences of mpfit are broadened together when there is an unsmoothed synthesis, or else the MOOG
+    # syntheses can run at the same time
+    fit_funct = counted_funct
+    fit_multifunct = None
+    fit_executor = None
+    if derivative != 'analytic':
+        if 'raw_synth' in fa:
+            fit_multifunct = counted_multifunct
+        elif jacobian_workers > 1:
+            fit_funct = sandboxed_funct
+            fit_executor = ThreadPoolExecutor(max_workers=jacobian_workers)
+
     # call for minimization
 
-    m = mpfit(myfunct, parinfo=parinfo, functkw=fa, ftol=1e-5, xtol=1e-5, gtol=1e-5, maxiter=20)
+    optimizer = OPTIMIZERS[method]
+    try:
+        m = optimizer(fit_funct, fa, vrot_info, tolerances, maxiter, derivative, multifunct=fit_multifunct,
+                      executor=fit_executor)
+
+        if vrot_limits is not None and m.params is not None and \
+                np.min(np.abs(np.array(vrot_info['limits']) - m.params[0])) < (vsini_tol or 1e-3) and \
+                list(vrot_info['limits']) != list(VSINI_LIMITS):
+            # the solution is at the edge of the window, continue with the full limits
+            print(star, 'vrot at the limit of', vrot_info['limits'], ', fitting inside', VSINI_LIMITS)
+            vrot_info['limits'] = list(VSINI_LIMITS)
+            vrot_info['value'] = float(m.params[0])
+            m = optimizer(fit_funct, fa, vrot_info, tolerances, maxiter, derivative, multifunct=fit_multifunct,
+                          executor=fit_executor)
+    finally:
+        if fit_executor is not None:
+            fit_executor.shutdown()
+        for sandbox in thread_sandboxes:
+            shutil.rmtree(sandbox, ignore_errors=True)
 
     dof = len(obs_flux) - len(m.params)
     parameters = convergence_info(m, parinfo, dof)
+    print(star, '%s: %d evaluations of the model' % (method, len(evaluations)))
 
-    return parameters
+    return parameters + [len(evaluations)]
 
-def creating_final_synth_spectra(vsini, star, spectrum, teff, feh, vtur, logg, fe_intervals, ldc, instr_broad):
-    obs_lambda, obs_flux, synth_data_fe = create_obs_synth_spec(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, vsini)
+def fit_line(p, star, vmac, line_interval, obs_lambda, obs_flux, ldc, CDELT1, instr_broad, run_dir=None,
+             atm_content=None, scratch_dir=None, **kwargs):
+    """
+    minimize_synth for one interval. With run_dir None the fit runs in its own sandbox with the atmosphere model
+    atm_content (bytes of the .atm file).
+    :param line_interval: pandas DataFrame with the row of the interval in vsini_intervals.list
+    """
+    if run_dir is None:
+        with moog_sandbox(star, root=scratch_dir) as run_dir:
+            with open(run_dir + '%s.atm' % star, 'wb') as atm:
+                atm.write(atm_content)
+            return fit_line(p, star, vmac, line_interval, obs_lambda, obs_flux, ldc, CDELT1, instr_broad,
+                            run_dir=run_dir, **kwargs)
+    return minimize_synth(p, star, vmac, line_interval, obs_lambda, obs_flux, ldc, CDELT1, instr_broad,
+                          run_dir=run_dir, **kwargs)
+
+
+def combine_line_vsini(vrot_lines, vrot_err_lines, n_sigma=LINE_OUTLIER_SIGMA):
+    """
+    Robust combination of the vsini of the lines: the lines further than n_sigma times their error and the scatter of
+    the lines (1.4826 MAD) from the median are outliers, the others are averaged with weights 1/err^2.
+    :return: vsini, its error (scaled by the reduced chi-square of the lines when it is above 1) and array of booleans
+             of the outlier lines
+    """
+    vrot_lines = np.asarray(vrot_lines, dtype=float)
+    vrot_err_lines = np.asarray(vrot_err_lines, dtype=float)
+    valid = np.isfinite(vrot_lines) & np.isfinite(vrot_err_lines) & (vrot_err_lines > 0)
+    if not np.any(valid):
+        return np.nan, np.nan, ~valid
+    median = np.median(vrot_lines[valid])
+    scatter = 1.4826*np.median(np.abs(vrot_lines[valid] - median))
+    outlier = ~valid
+    outlier[valid] = np.abs(vrot_lines[valid] - median) > n_sigma*np.sqrt(vrot_err_lines[valid]**2 + scatter**2)
+
+    weights = 1./vrot_err_lines[~outlier]**2
+    vrot = np.sum(weights*vrot_lines[~outlier])/np.sum(weights)
+    vrot_err = np.sqrt(1./np.sum(weights))
+    if np.sum(~outlier) > 1:
+        chi_reduced = np.sum(weights*(vrot_lines[~outlier] - vrot)**2)/(np.sum(~outlier) - 1)
+        vrot_err *= np.sqrt(max(1., chi_reduced))
+    return vrot, vrot_err, outlier
+
+
+def minimize_lines(p, star, vmac, fe_intervals, obs_lambda, obs_flux, ldc, CDELT1, instr_broad, run_dir=RUN_PATH,
+                   line_workers=1, lines_table_file=None, scratch_dir=None, **kwargs):
+    """
+    Fits vsini in each interval of fe_intervals independently and combines the results with combine_line_vsini.
+    Same parameters as minimize_synth, and:
+    :param line_workers: int, number of intervals fitted at the same time, each in its own process and sandbox
+    :param lines_table_file: string, file where the vsini of every line is saved
+    :param scratch_dir: string, directory of the sandboxes of the parallel fits (default: SCRATCH_PATH)
+    :return: same list as minimize_synth, with the number of lines used in place of the iterations
+    """
+    obs_lambda = np.asarray(obs_lambda)
+    obs_flux = np.asarray(obs_flux)
+    kwargs.pop('chi2_curve_file', None)
+    # the syntheses need a margin around each interval for the broadening
+    kwargs['windows'] = True
+
+    lines = []
+    for i in range(len(fe_intervals)):
+        line_interval = fe_intervals.iloc[[i]]
+        select = (obs_lambda >= line_interval['ll_si'].iloc[0]) & (obs_lambda <= line_interval['ll_sf'].iloc[0])
+        lines.append((line_interval, obs_lambda[select], obs_flux[select]))
+
+    def failed_line(line_interval):
+        print('Failed line', star, line_interval['name'].iloc[0])
+        traceback.print_exc()
+        return [np.nan, np.nan, 0, np.nan, np.nan, 0, 0]
+
+    results = []
+    if line_workers > 1:
+        with open(run_dir + '%s.atm' % star, 'rb') as atm:
+            atm_content = atm.read()
+        with ProcessPoolExecutor(max_workers=min(line_workers, len(lines))) as pool:
+            futures = [pool.submit(cache_counted, fit_line, p, star, vmac, line_interval, line_lambda, line_flux, ldc, CDELT1,
+                                   instr_broad, atm_content=atm_content, scratch_dir=scratch_dir, **kwargs)
+                       for line_interval, line_lambda, line_flux in lines]
+            for future, (line_interval, line_lambda, line_flux) in zip(futures, lines):
+                try:
+                    results.append(counted_result(future))
+                except Exception:
+                    results.append(failed_line(line_interval))
+    else:
+        for line_interval, line_lambda, line_flux in lines:
+            try:
+                results.append(fit_line(p, star, vmac, line_interval, line_lambda, line_flux, ldc, CDELT1,
+                                        instr_broad, run_dir=run_dir, **kwargs))
+            except Exception:
+                results.append(failed_line(line_interval))
+
+    lines_table = pd.DataFrame(results, columns=['vrot', 'vrot_err', 'niter', 'chi2', 'chi2_reduced', 'status',
+                                                 'evaluations'])
+    lines_table.insert(0, 'name', fe_intervals['name'].to_numpy())
+    lines_table.insert(1, 'll_si', fe_intervals['ll_si'].to_numpy())
+    lines_table.insert(2, 'll_sf', fe_intervals['ll_sf'].to_numpy())
+    # mpfit status <= 0 are failed fits
+    lines_table.loc[lines_table['status'] <= 0, ['vrot', 'vrot_err']] = np.nan
+    vrot, vrot_err, outlier = combine_line_vsini(lines_table['vrot'], lines_table['vrot_err'])
+    lines_table['outlier'] = outlier.astype(int)
+    if lines_table_file is not None:
+        lines_table.to_csv(lines_table_file, index=False, sep='\t')
+    for name in lines_table['name'][outlier]:
+        print(star, 'outlier line:', name)
+
+    n_lines = int(np.sum(~outlier))
+    chi2 = float(np.nansum(lines_table['chi2'][~outlier]))
+    dof = max(1, int(sum(len(line_flux) for (line_interval, line_lambda, line_flux), used in zip(lines, ~outlier)
+                         if used)) - n_lines)
+    print(star, ('vrot (%d of %d lines): %s +- %s' % (n_lines, len(lines), round(vrot, 3), round(vrot_err, 3))))
+    return [round(vrot, 3), round(vrot_err, 3), n_lines, round(chi2, 3), round(chi2/dof, 4), int(n_lines > 0),
+            int(lines_table['evaluations'].sum())]
+
+
+def creating_final_synth_spectra(vsini, star, spectrum, teff, feh, vtur, logg, fe_intervals, ldc, instr_broad, **kwargs):
+    obs_lambda, obs_flux, synth_data_fe = create_obs_synth_spec(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, vsini, **kwargs)
     flux_ratio = (obs_flux / synth_data_fe)
     flux_diff = (obs_flux - synth_data_fe)
     synth_normalized_spectra = pd.DataFrame(data=np.column_stack((obs_lambda, synth_data_fe, flux_diff, flux_ratio)),columns=['wl','flux', 'flux_diff', 'flux_ratio'])
     synth_normalized_spectra.to_csv('running_dir/%s_synth_normalized_spectra.rdb' % star, index = False, sep = '\t')
 
 
-def get_spectra(fitsfile):
-    img_data, img_header = fits.getdata(fitsfile, header=True)
-    cdelta1 = img_header['CDELT1']
-    crval1  = img_header['CRVAL1']
-    npoints = img_header['NAXIS1']
-    ll = np.arange(0,npoints)*cdelta1+crval1
+def get_spectra(fitsfile, lambda_min=None, lambda_max=None, margin=2):
+    """
+    Reads a 1D spectrum with a linear wavelength solution (CRVAL1, CDELT1). With lambda_min and lambda_max the file is
+    memory-mapped and only the pixels from lambda_min to lambda_max (plus margin pixels on each side, for the
+    interpolation to the rounded wavelengths) are read.
+    :param fitsfile: string, path of the FITS file
+    :param lambda_min: float, first wavelength needed (default: start of the spectrum)
+    :param lambda_max: float, last wavelength needed (default: end of the spectrum)
+    :param margin: int, number of extra pixels read on each side
+    :return: arrays of wavelength and flux, and the wavelength step CDELT1
+    """
+    with fits.open(fitsfile, memmap=True) as hdul:
+        img_header = hdul[0].header
+        cdelta1 = img_header['CDELT1']
+        crval1  = img_header['CRVAL1']
+        npoints = img_header['NAXIS1']
+        first = 0
+        last = npoints
+        if lambda_min is not None:
+            first = min(max(int(np.floor((lambda_min - crval1)/cdelta1)) - margin, 0), npoints)
+        if lambda_max is not None:
+            last = max(min(int(np.ceil((lambda_max - crval1)/cdelta1)) + 1 + margin, npoints), first)
+        # copy the slice, so that the file can be closed
+        img_data = np.array(hdul[0].data[first:last], dtype=float)
+    ll = np.arange(first,last)*cdelta1+crval1
     return ll, img_data, cdelta1
 
+def window_grid(fe_intervals, step):
+    """
+    Grid of round wavelengths of the observed spectrum (from the first ll_li in steps of step, rounded to 3 decimals)
+    only inside the intervals (from the smallest to the largest of ll_li, ll_lf, ll_si and ll_sf of each line, as a few
+    small intervals end outside the large one). Overlapping intervals are merged, so the wavelength increases and every
+    point appears once.
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :param step: float, wavelength step, rounded to 3 decimals
+    :return: array of the wavelengths of all the windows one after the other
+    """
+    start = np.min(fe_intervals['ll_li'])
+    # number of points of the whole grid, np.arange(start, last ll_lf + step, step)
+    npoints = int(np.ceil((np.max(fe_intervals['ll_lf']) + step - start)/step))
+    windows = []
+    limits = fe_intervals[['ll_li', 'll_lf', 'll_si', 'll_sf']].to_numpy()
+    for lambda_i, lambda_f in sorted(zip(np.min(limits, axis=1), np.max(limits, axis=1))):
+        if windows and lambda_i <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], lambda_f)
+        else:
+            windows.append([lambda_i, lambda_f])
+
+    chunks = []
+    for lambda_i, lambda_f in windows:
+        # one step more on each side, the rounding decides which points are inside
+        k = np.arange(max(np.floor((lambda_i - start)/step) - 1, 0),
+                      min(np.ceil((lambda_f - start)/step) + 2, npoints))
+        ll = np.round(start + k*step, 3)
+        chunks.append(ll[(ll >= lambda_i) & (ll <= lambda_f)])
+    return np.concatenate(chunks)
+
+
+def resample_windows(ll, flux, fe_intervals, delta_lambda):
+    """
+    Linear interpolation of the observed spectrum to the round wavelengths of window_grid, only inside the intervals,
+    instead of the whole range from the first ll_li to the last ll_lf.
+    :param ll: array, wavelength of the observed spectrum
+    :param flux: array, flux of the observed spectrum
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :param delta_lambda: float, wavelength step of the observed spectrum
+    :return: arrays of wavelength and flux of all the windows one after the other
+    """
+    grid = window_grid(fe_intervals, round(float(delta_lambda), 3))
+    return grid, interp1d(ll, flux)(grid)
+
+
 def get_intervals_normalized_spectra(ll, flux, fe_intervals):
-    obs_data_norm = []
-    obs_lambda = []
-    fe_intervals_list = [row for row in fe_intervals[['ll_li', 'll_lf','ll_si','ll_sf']].to_numpy()]
-    for i,(ll_li, ll_lf, ll_si, ll_sf) in enumerate(fe_intervals_list):
-        # get data from large intervals to do normalisation in each region
-        select_ll = np.where((ll >= ll_li) & (ll <= ll_lf))[0]
-        obs_data_one_large_interval = flux[select_ll]
-
-        # m : mean value of larger interval to divide the smaller interval by
-        m = norm(obs_data_one_large_interval)
-
-        # get data from smaller intervals and normalising it
-        select_sll = np.where((ll >= ll_si) & (ll <= ll_sf))[0]
-        obs_data_one_small_interval = flux[select_sll]/m
-        obs_lambda_one_small_interval = ll[select_sll]
-
-        #print 'obs_data_one_small_interval',  obs_data_one_small_interval
-        #obs_data_norm.append(obs_data_one_small_interval)
-        #obs_lambda.append(obs_lambda_one_small_interval)
-        obs_data_norm.extend(list(obs_data_one_small_interval))
-        obs_lambda.extend(list(obs_lambda_one_small_interval))
-
-    # single list with data from all fe regions
-    
-    #print ('finished')
-    #print 'obs_data', obs_data_norm
-    #obs_data_norm_flat = [float(value) for sublist in obs_data_norm for value in sublist]
-    #print 'obs_data_norm', obs_data_norm
-    # single list with wavelength points from all fe regions
-    #obs_lambda_flat = [float(value) for sublist in obs_lambda for value in sublist]
-    #print ('obs_data all together', obs_data_norm_flat)
-    #print "obs_lambda", np.array(obs_lambda)
-    #return obs_lambda_flat, obs_data_norm_flat
+    # get data from large intervals to do normalisation in each region
+    # levels : mean value of each larger interval to divide the smaller interval by
+    large_intervals = IntervalIndex(ll, fe_intervals, columns=('ll_li', 'll_lf'))
+    levels = continuum_levels(large_intervals.split(flux))
+
+    # get data from smaller intervals and normalising it, in a single list with data from all fe regions
+    small_intervals = IntervalIndex(ll, fe_intervals)
+    obs_data_norm = list(np.concatenate([obs_data_one_small_interval/m for obs_data_one_small_interval, m
+                                         in zip(small_intervals.split(flux), levels)]))
+    obs_lambda = list(small_intervals.take(ll))
     return obs_lambda,obs_data_norm
 
 
-def create_atm_model(teff, log_g, feh, vtur, star):
-    owd = os.getcwd()
-    os.chdir(RUN_PATH)
-    ## Modify to use functions in run_programs
-    os.system('echo %s %s %s | ' % (teff, log_g, feh) + MODELS_PATH + 'intermod.e' )
-    os.system('echo %s | ' % vtur + MODELS_PATH + 'transform.e' )
-    os.system('mv out.atm %s.atm' %star)
-    os.system('rm mod* for*')
-    os.chdir(owd)
+def atm_cache_file(teff, log_g, feh, vtur):
+    """
+    :return: string, path of the cached atmosphere model for these parameters (as they are given to intermod.e and
+             transform.e)
+    """
+    key = hashlib.sha256(('%s %s %s %s' % (teff, log_g, feh, vtur)).encode()).hexdigest()
+    return ATM_CACHE_PATH + key + '.atm'
+
+
+def read_atm_cache(teff, log_g, feh, vtur):
+    """
+    :return: bytes, content of the cached atmosphere model, or None if it is not cached or its content hash does not
+             match the one saved with it
+    """
+    if ATM_CACHE_PATH is None:
+        return None
+    atm_file = atm_cache_file(teff, log_g, feh, vtur)
+    try:
+        with open(atm_file, 'rb') as atm:
+            content = atm.read()
+        with open(atm_file + '.sha256') as digest:
+            if digest.read().strip() != hashlib.sha256(content).hexdigest():
+                return None
+    except OSError:
+        return None
+    return content
+
+
+def write_atm_cache(teff, log_g, feh, vtur, content):
+    if ATM_CACHE_PATH is None:
+        return
+    os.makedirs(ATM_CACHE_PATH, exist_ok=True)
+    atm_file = atm_cache_file(teff, log_g, feh, vtur)
+    atomic_write(atm_file, lambda tmp: tmp.write(content))
+    atomic_write(atm_file + '.sha256', lambda tmp: tmp.write(hashlib.sha256(content).hexdigest().encode()))
+
+
+def create_atm_model(teff, log_g, feh, vtur, star, run_dir=RUN_PATH):
+    content = read_atm_cache(teff, log_g, feh, vtur)
+    if content is not None:
+        with open(run_dir + '%s.atm' % star, 'wb') as atm:
+            atm.write(content)
+        return
+
+    # run inside run_dir without os.chdir, so that concurrent fits do not change each other's working directory
+    run_program(MODELS_PATH + 'intermod.e', run_dir, '%s %s %s\n' % (teff, log_g, feh))
+    run_program(MODELS_PATH + 'transform.e', run_dir, '%s\n' % vtur)
+    os.replace(run_dir + 'out.atm', run_dir + '%s.atm' % star)
+    for tmp_file in glob.glob(run_dir + 'mod*') + glob.glob(run_dir + 'for*'):
+        os.remove(tmp_file)
+
+    with open(run_dir + '%s.atm' % star, 'rb') as atm:
+        write_atm_cache(teff, log_g, feh, vtur, atm.read())
+
+
+def prebuild_atm_models(atm_parameters, workers=1, scratch_dir=None):
+    """
+    Builds, at the same time, the atmosphere models that are not yet in the cache.
+    :param atm_parameters: list of tuples (teff, logg, feh, vtur)
+    :param workers: int, number of models built at the same time
+    :param scratch_dir: string, directory for the temporary files of intermod.e and transform.e
+    """
+    missing = [parameters for parameters in dict.fromkeys(atm_parameters) if read_atm_cache(*parameters) is None]
+
+    def build(parameters):
+        with moog_sandbox('atm', root=scratch_dir) as run_dir:
+            # not named model, the mod* files are removed after transform.e
+            create_atm_model(*parameters, 'atm', run_dir=run_dir)
+
+    print('Building %d atmosphere models' % len(missing))
+    # the work is done by external programs, threads are enough to run them in parallel
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(build, missing))
+
+
+def star_atm_parameters(star_info):
+    """
+    :param star_info: dictionary, one row of stars_information.csv
+    :return: list of tuples (teff, logg, feh, vtur) of the atmosphere models used by get_vsini_error
+    """
+    teff = float(star_info["Teff"])
+    eteff = float(star_info["eTeff"])
+    logg = float(star_info["logg"])
+    feh = float(star_info["feh"])
+    efeh = float(star_info["efeh"])
+    vtur = float(star_info["vtur"])
+    return [(teff, logg, feh, vtur), (teff-eteff, logg, feh, vtur), (teff+eteff, logg, feh, vtur),
+            (teff, logg, feh-efeh, vtur), (teff, logg, feh+efeh, vtur)]
 
 
 def get_vmac(teff, log_g):
@@ -326,34 +1602,167 @@ def get_vmac(teff, log_g):
     return vmac_funct
 
 
-def get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals):
-    create_atm_model(teff, logg, feh, vtur, star)
-    vmac = round(float(get_vmac(teff, logg)), 3)
+def star_key(star):
+    """
+    Name of a star reduced to the form used to match the literature table: lower case, without spaces, underscores and
+    hyphens (KPS-1, KPS 1 and kps1 are the same star). The + sign is kept, so BD+06 and BD-06 stay different.
+    """
+    return re.sub(r'[\s_\-]', '', str(star).lower())
+
+
+@lru_cache(maxsize=None)
+def load_literature_vsini(file_name=LITERATURE_FILE):
+    """
+    Reads the literature vsini once per process.
+    :param file_name: string, tab separated table with the columns of Literature_values.txt
+    :return: pandas Series of vsini in km/s indexed by star_key (median, or average, or nasa value, the first given)
+    """
+    table = pd.read_csv(file_name, sep='\t')
+    vsini = table['median: vsini (km/s)'].fillna(table['average: vsini (km/s)']).fillna(table['nasa: vsini (km/s)'])
+    vsini.index = table['Star'].map(star_key)
+    vsini = vsini[~vsini.index.duplicated(keep='first')]
+    return vsini.dropna()
+
+
+def literature_vsini(star, file_name=LITERATURE_FILE):
+    """
+    :return: float, literature vsini of the star in km/s, or None if the star is not in the table
+    """
+    try:
+        vsini = load_literature_vsini(file_name)
+    except (OSError, KeyError, pd.errors.ParserError):
+        return None
+    value = vsini.get(star_key(star))
+    return None if value is None else float(value)
+
+
+@lru_cache(maxsize=None)
+def file_digest(path, size, mtime):
+    """
+    sha256 of the content of a file, computed once per process for each size and modification time of the file.
+    :param path: string, path of the file
+    :param size: int, st_size of the file (part of the key of the cache)
+    :param mtime: float, st_mtime of the file (part of the key of the cache)
+    :return: bytes, digest of the content
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as content:
+        for block in iter(lambda: content.read(1024**2), b''):
+            sha.update(block)
+    return sha.digest()
+
+
+def obs_cache_file(spectrum, fe_intervals):
+    """
+    :param spectrum: string, path of the FITS file
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :return: string, path of the cached normalized spectrum for the content of the FITS file, the intervals and
+             OBS_CACHE_VERSION
+    """
+    stat = os.stat(spectrum)
+    sha = hashlib.sha256(file_digest(os.path.abspath(spectrum), stat.st_size, stat.st_mtime))
+    sha.update(fe_intervals[['ll_li', 'll_lf', 'll_si', 'll_sf']].to_numpy(dtype=float).tobytes())
+    sha.update(repr(OBS_CACHE_VERSION).encode())
+    return OBS_CACHE_PATH + sha.hexdigest() + '.npz'
+
+
+def read_obs_cache(npz_file):
+    """
+    :param npz_file: string, path from obs_cache_file
+    :return: dictionary with the arrays saved by write_obs_cache, or None if the spectrum is not cached
+    """
+    try:
+        with np.load(npz_file) as cached:
+            return {name: cached[name] for name in ['obs_lambda', 'obs_flux', 'delta_lambda', 'offsets']}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def write_obs_cache(npz_file, **arrays):
+    os.makedirs(OBS_CACHE_PATH, exist_ok=True)
+    atomic_write(npz_file, lambda tmp: np.savez(tmp, **arrays))
+
+
+def normalized_obs_spectrum(spectrum, fe_intervals):
+    """
+    Reads the observed spectrum, interpolates it to a grid of round wavelengths and normalizes the intervals, or loads
+    the result from OBS_CACHE_PATH when the same FITS file was normalized before with the same intervals.
+    :param spectrum: string, path of the FITS file
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :return: lists of wavelength and normalized flux of the small intervals, the wavelength step, and array of the
+             offset of each interval in the lists (the last value is the number of points)
+    """
+    npz_file = None if OBS_CACHE_PATH is None else obs_cache_file(spectrum, fe_intervals)
+    cached = None if npz_file is None else read_obs_cache(npz_file)
+    if cached is not None:
+        return (list(cached['obs_lambda']), list(cached['obs_flux']), float(cached['delta_lambda']),
+                cached['offsets'])
 
     # read observational spectra
-    obs_lambda_full_spectrum, obs_data_full_spectrum, delta_lambda =  get_spectra(spectrum)
-    interp_function = interp1d(obs_lambda_full_spectrum, obs_data_full_spectrum)
-    # create wavelength array equal to that of the synthetic models
-    # starts at the first value of the first fe region and ends at the end value of the last region
-    obs_lambda_interp = np.arange(np.min(fe_intervals['ll_li']),np.max(fe_intervals['ll_lf'])+round(float(delta_lambda), 3), round(float(delta_lambda), 3))
-    obs_lambda_interp = np.round(obs_lambda_interp,3)
+    obs_lambda_full_spectrum, obs_data_full_spectrum, delta_lambda =  get_spectra(spectrum, np.min(fe_intervals['ll_li']),
+                                                                                  np.max(fe_intervals['ll_lf']))
+    # create wavelength array equal to that of the synthetic models, only inside the intervals
     # Why do we need to interpolate??? To get round values for the synthesis calculation
-
-    obs_data_interp = interp_function(obs_lambda_interp)
-    #print 'obs lambda interpolated', obs_lambda_interp
-    #print 'obs data interpolated' , obs_data_interp
+    obs_lambda_interp, obs_data_interp = resample_windows(obs_lambda_full_spectrum, obs_data_full_spectrum,
+                                                          fe_intervals, delta_lambda)
 
     # get wavelength points and flux data for Fe lines in interpolated rounded wavelenghts
-
     obs_lambda_flat, obs_data_norm_flat = get_intervals_normalized_spectra(obs_lambda_interp, obs_data_interp, fe_intervals)
+    offsets = np.cumsum([0] + [len(segment) for segment in IntervalIndex(obs_lambda_interp, fe_intervals).segments])
+
+    if npz_file is not None:
+        write_obs_cache(npz_file, obs_lambda=obs_lambda_flat, obs_flux=obs_data_norm_flat, delta_lambda=delta_lambda,
+                        offsets=offsets)
+    return obs_lambda_flat, obs_data_norm_flat, delta_lambda, offsets
+
+
+def get_obs_spectrum(star, spectrum, fe_intervals):
+    """
+    Reads the observed spectrum, interpolates it to a grid of round wavelengths and normalizes the intervals
+    (normalized_obs_spectrum). The normalized spectrum is saved in RUN_PATH/<star>_obs_normalized_spectra.rdb.
+    :return: tuple (wavelength, normalized flux, wavelength step) used by get_vsini
+    """
+    obs_lambda_flat, obs_data_norm_flat, delta_lambda, offsets = normalized_obs_spectrum(spectrum, fe_intervals)
 
     obs_normalized_spectra = pd.DataFrame(data=np.column_stack((obs_lambda_flat,obs_data_norm_flat)),columns=['wl','flux'])
     obs_normalized_spectra.to_csv(RUN_PATH+'/%s_obs_normalized_spectra.rdb' % star, index = False, sep = '\t')
 
-    par_list = [0.5]
+    return obs_lambda_flat, obs_data_norm_flat, delta_lambda
+
+
+def get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, run_dir=None, scratch_dir=None,
+              obs_spectrum=None, vrot_start=None, per_line=False, **kwargs):
+    """
+    :param obs_spectrum: tuple from get_obs_spectrum, to fit a spectrum that was already read (default: read spectrum)
+    :param vrot_start: float, starting vsini of the fit in km/s (default: the start option of minimize_synth)
+    :param per_line: bool, fit every interval independently and combine them (minimize_lines) instead of one fit of
+                     all the intervals together
+    """
+    if run_dir is None:
+        # every fit runs MOOG in its own sandbox, removed when the fit ends
+        with moog_sandbox(star, root=scratch_dir) as run_dir:
+            return get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, run_dir=run_dir,
+                             obs_spectrum=obs_spectrum, vrot_start=vrot_start, per_line=per_line, **kwargs)
+
+    create_atm_model(teff, logg, feh, vtur, star, run_dir=run_dir)
+    vmac = round(float(get_vmac(teff, logg)), 3)
+
+    if obs_spectrum is None:
+        obs_spectrum = get_obs_spectrum(star, spectrum, fe_intervals)
+    obs_lambda_flat, obs_data_norm_flat, delta_lambda = obs_spectrum
+
+    par_list = [5.0]  # starting vsini when the fit is not warm started (start='fixed')
+    if vrot_start is not None:
+        par_list = [vrot_start]
+        kwargs['start'] = 'fixed'
 
-    final_vrot  = minimize_synth(p=par_list, star=star, vmac=vmac, fe_intervals=fe_intervals,
-                                obs_lambda=obs_lambda_flat, obs_flux=obs_data_norm_flat, ldc = ldc, CDELT1 = delta_lambda, instr_broad = instr_broad)
+    minimize = minimize_synth
+    if per_line:
+        minimize = minimize_lines
+        kwargs['scratch_dir'] = scratch_dir
+    final_vrot  = minimize(p=par_list, star=star, vmac=vmac, fe_intervals=fe_intervals,
+                                obs_lambda=obs_lambda_flat, obs_flux=obs_data_norm_flat, ldc = ldc, CDELT1 = delta_lambda, instr_broad = instr_broad,
+                                run_dir=run_dir, **kwargs)
 
     vrot = final_vrot[0]
     vrot_err = final_vrot[1]
@@ -369,13 +1778,47 @@ def get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_interv
 
     return vrot, vrot_err, vmac, status
 
-def get_vsini_error(star, spectrum, teff, eteff, feh, efeh, vtur, logg, ldc, instr_broad, fe_intervals):
+def get_vsini_error(star, spectrum, teff, eteff, feh, efeh, vtur, logg, ldc, instr_broad, fe_intervals,
+                    error_workers=1, error_fits='warm', **kwargs):
+    """
+    vsini of the star and its error from the fits with Teff+-eTeff and [Fe/H]+-efeh.
+    :param error_workers: int, number of the fits run at the same time, each in its own process
+    :param error_fits: string, 'warm' to start the four perturbed fits from the nominal vsini, inside a window around
+                       it and with a tolerance in km/s (ERROR_FIT_WINDOW, ERROR_FIT_TOL, ERROR_FIT_MAXITER), after the
+                       nominal fit; 'independent' to run the five fits in the same way and at the same time
+    :return: vrot, vrot_err, vmac, status of the nominal fit and the final error of vsini
+    """
     #parameters = ['teff', 'feh']
-    vrot, vrot_err, vmac, status = get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals)
-    vrot_tm, vrot_err_tm, vmac_tm, status_tm = get_vsini(star, spectrum, teff-eteff, feh, vtur, logg, ldc, instr_broad, fe_intervals)
-    vrot_tp, vrot_err_tp, vmac_tp, status_tp = get_vsini(star, spectrum, teff+eteff, feh, vtur, logg, ldc, instr_broad, fe_intervals)
-    vrot_fm, vrot_err_fm, vmac_fm, status_fm = get_vsini(star, spectrum, teff, feh-efeh, vtur, logg, ldc, instr_broad, fe_intervals)
-    vrot_fp, vrot_err_fp, vmac_fp, status_fp = get_vsini(star, spectrum, teff, feh+efeh, vtur, logg, ldc, instr_broad, fe_intervals)
+    # the five fits use the same observed spectrum, read and normalized only once
+    kwargs['obs_spectrum'] = get_obs_spectrum(star, spectrum, fe_intervals)
+    fits_parameters = [(teff, feh), (teff-eteff, feh), (teff+eteff, feh), (teff, feh-efeh), (teff, feh+efeh)]
+    fits_kwargs = [dict(kwargs, chi2_curve_file=RUN_PATH+'%s_chi2_curve.rdb' % star,
+                        lines_table_file=RUN_PATH+'%s_lines_vsini.rdb' % star)] + [kwargs]*4
+
+    def run_fits(fits_parameters, fits_kwargs):
+        if error_workers > 1 and len(fits_parameters) > 1:
+            with ProcessPoolExecutor(max_workers=min(error_workers, len(fits_parameters))) as pool:
+                futures = [pool.submit(cache_counted, get_vsini, star, spectrum, teff_fit, feh_fit, vtur, logg, ldc, instr_broad,
+                                       fe_intervals, **fit_kwargs)
+                           for (teff_fit, feh_fit), fit_kwargs in zip(fits_parameters, fits_kwargs)]
+                return [counted_result(future) for future in futures]
+        return [get_vsini(star, spectrum, teff_fit, feh_fit, vtur, logg, ldc, instr_broad, fe_intervals, **fit_kwargs)
+                for (teff_fit, feh_fit), fit_kwargs in zip(fits_parameters, fits_kwargs)]
+
+    if error_fits == 'warm':
+        fits = run_fits(fits_parameters[:1], fits_kwargs[:1])
+        vrot_nominal, vrot_err_nominal = fits[0][0], fits[0][1]
+        window = max(ERROR_FIT_WINDOW, 10*vrot_err_nominal)
+        warm_kwargs = dict(kwargs, vrot_start=vrot_nominal, maxiter=ERROR_FIT_MAXITER, vsini_tol=ERROR_FIT_TOL,
+                           vrot_limits=[max(VSINI_LIMITS[0], vrot_nominal - window),
+                                        min(VSINI_LIMITS[1], vrot_nominal + window)])
+        fits += run_fits(fits_parameters[1:], [warm_kwargs]*4)
+    else:
+        fits = run_fits(fits_parameters, fits_kwargs)
+
+    (vrot, vrot_err, vmac, status), (vrot_tm, vrot_err_tm, vmac_tm, status_tm), \
+        (vrot_tp, vrot_err_tp, vmac_tp, status_tp), (vrot_fm, vrot_err_fm, vmac_fm, status_fm), \
+        (vrot_fp, vrot_err_fp, vmac_fp, status_fp) = fits
 
     vsini_final_err = np.sqrt( np.abs( (vrot_tm - vrot) - (vrot_tp - vrot) )**2. + np.abs( (vrot_fm - vrot) - (vrot_fp - vrot) )**2. + vrot_err**2. )
 
@@ -388,18 +1831,137 @@ def get_vsini_error(star, spectrum, teff, eteff, feh, efeh, vtur, logg, ldc, ins
     return vrot, vrot_err, vmac, status, vsini_final_err
 
 
-def create_obs_synth_spec(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, vrot_test):
+def estimate_flux_noise(obs_flux):
+    """
+    Noise of the normalized flux from the median of the second differences (DER_SNR, Stoehr et al. 2008).
+    :return: float, standard deviation of the noise
+    """
+    obs_flux = np.asarray(obs_flux)
+    return float(1.482602/np.sqrt(6.)*np.median(np.abs(2.*obs_flux[2:-2] - obs_flux[:-4] - obs_flux[4:])))
+
+
+def draw_mc_parameters(teff, eteff, feh, efeh, n_draws, correlation=0., rng=None):
+    """
+    Teff and [Fe/H] from a bivariate normal distribution, rounded to steps of eteff/MC_ATM_STEPS_PER_SIGMA and
+    efeh/MC_ATM_STEPS_PER_SIGMA.
+    :param correlation: float, correlation coefficient between Teff and [Fe/H]
+    :return: arrays of teff and feh
+    """
+    rng = np.random.default_rng(rng)
+    covariance = [[eteff**2, correlation*eteff*efeh], [correlation*eteff*efeh, efeh**2]]
+    teff_draws, feh_draws = rng.multivariate_normal([teff, feh], covariance, size=n_draws).T
+    if eteff > 0:
+        teff_step = eteff/MC_ATM_STEPS_PER_SIGMA
+        teff_draws = teff + np.round((teff_draws - teff)/teff_step)*teff_step
+    if efeh > 0:
+        feh_step = efeh/MC_ATM_STEPS_PER_SIGMA
+        feh_draws = feh + np.round((feh_draws - feh)/feh_step)*feh_step
+    return np.round(teff_draws, 1), np.round(feh_draws, 3)
+
+
+def fit_mc_atmosphere(star, spectrum, teff, feh, vtur, logg, instr_broad, fe_intervals, obs_spectrum, flux_noise,
+                      noise_seeds, scratch_dir=None, **kwargs):
+    """
+    Monte Carlo fits of the draws with the same atmosphere model, in one MOOG sandbox: the unsmoothed synthesis is done
+    once and broadened for all the noise realizations.
+    :param obs_spectrum: tuple from get_obs_spectrum
+    :param flux_noise: float, standard deviation of the noise added to the normalized flux
+    :param noise_seeds: list of seeds of the noise realizations, one per draw
+    :return: list of (vrot, status), one per draw
+    """
+    # the draws can go beyond the limb darkening table, the coefficient is taken at its edge
+    ldc = float(interpolation_function(*[np.clip(value, np.min(grid), np.max(grid))
+                                         for value, grid in zip([teff, logg, feh], Variables)]))
+    obs_lambda, obs_flux, delta_lambda = obs_spectrum
+    results = []
+    with moog_sandbox(star, root=scratch_dir) as run_dir:
+        for seed in noise_seeds:
+            noisy_flux = obs_flux + np.random.default_rng(seed).normal(0., flux_noise, len(obs_flux))
+            vrot, vrot_err, vmac, status = get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad,
+                                                     fe_intervals, run_dir=run_dir,
+                                                     obs_spectrum=(obs_lambda, noisy_flux, delta_lambda), **kwargs)
+            results.append((vrot, status))
+    return results
+
+
+def get_vsini_mc(star, spectrum, teff, eteff, feh, efeh, vtur, logg, instr_broad, fe_intervals, vrot, vrot_err,
+                 mc_draws=200, mc_correlation=0., mc_seed=None, error_workers=1, **kwargs):
+    """
+    Monte Carlo error of vsini: fits of mc_draws spectra with noise added and Teff, [Fe/H] (and the limb darkening
+    coefficient) drawn from their errors. The fits start from the nominal vsini as the perturbed fits of
+    get_vsini_error and use the NumPy broadening of one unsmoothed synthesis per atmosphere model. The draws are saved
+    in RUN_PATH/<star>_mc_vsini.rdb and the percentiles in RUN_PATH/<star>_mc_percentiles.rdb.
+    :param vrot: float, nominal vsini
+    :param vrot_err: float, error of the nominal vsini
+    :param mc_draws: int, number of draws
+    :param mc_correlation: float, correlation coefficient between Teff and [Fe/H]
+    :param mc_seed: int, seed of the random draws (default: random)
+    :param error_workers: int, number of atmosphere models fitted at the same time, each in its own process
+    :return: pandas Series of vsini at MC_PERCENTILES
+    """
+    seed_sequence = np.random.SeedSequence(mc_seed)
+    parameters_seed, noise_seed = seed_sequence.spawn(2)
+    teff_draws, feh_draws = draw_mc_parameters(teff, eteff, feh, efeh, mc_draws, correlation=mc_correlation,
+                                               rng=parameters_seed)
+    # one seed per draw, the noise of a draw does not depend on how the draws are grouped
+    noise_seeds = noise_seed.spawn(mc_draws)
+
+    obs_spectrum = kwargs.pop('obs_spectrum', None) or get_obs_spectrum(star, spectrum, fe_intervals)
+    flux_noise = estimate_flux_noise(obs_spectrum[1])
+    print(star, 'Monte Carlo: %d draws, flux noise %.4f' % (mc_draws, flux_noise))
+
+    window = max(ERROR_FIT_WINDOW, 10*vrot_err)
+    kwargs.update({'synth_mode': 'broaden', 'vrot_start': vrot, 'maxiter': ERROR_FIT_MAXITER,
+                   'vsini_tol': ERROR_FIT_TOL, 'vrot_limits': [max(VSINI_LIMITS[0], vrot - window),
+                                                              min(VSINI_LIMITS[1], vrot + window)]})
+    kwargs.pop('chi2_curve_file', None)
+    kwargs.pop('lines_table_file', None)
+
+    atmospheres = {}
+    for i, atmosphere in enumerate(zip(teff_draws, feh_draws)):
+        atmospheres.setdefault(atmosphere, []).append(i)
+    print(star, 'Monte Carlo: %d atmosphere models' % len(atmospheres))
+
+    def group_args(atmosphere, draws):
+        return (star, spectrum, atmosphere[0], atmosphere[1], vtur, logg, instr_broad, fe_intervals, obs_spectrum,
+                flux_noise, [noise_seeds[i] for i in draws])
+
+    if error_workers > 1:
+        with ProcessPoolExecutor(max_workers=min(error_workers, len(atmospheres))) as pool:
+            futures = [pool.submit(cache_counted, fit_mc_atmosphere, *group_args(atmosphere, draws), **kwargs)
+                       for atmosphere, draws in atmospheres.items()]
+            groups = [counted_result(future) for future in futures]
+    else:
+        groups = [fit_mc_atmosphere(*group_args(atmosphere, draws), **kwargs)
+                  for atmosphere, draws in atmospheres.items()]
+
+    vrot_draws = np.empty(mc_draws)
+    status_draws = np.empty(mc_draws, dtype=int)
+    for draws, results in zip(atmospheres.values(), groups):
+        vrot_draws[draws] = [vrot_draw for vrot_draw, status in results]
+        status_draws[draws] = [status for vrot_draw, status in results]
+
+    mc_table = pd.DataFrame({'teff': teff_draws, 'feh': feh_draws, 'vrot': vrot_draws, 'status': status_draws})
+    mc_table.to_csv(RUN_PATH + '%s_mc_vsini.rdb' % star, index=False, sep='\t')
+    percentiles = pd.Series(np.percentile(vrot_draws, MC_PERCENTILES), index=MC_PERCENTILES, name='vrot')
+    percentiles.to_frame().to_csv(RUN_PATH + '%s_mc_percentiles.rdb' % star, index_label='percentile', sep='\t')
+    print(star, 'Monte Carlo vrot percentiles:', ', '.join('%s: %.3f' % (q, v) for q, v in percentiles.items()))
+    return percentiles
+
+
+def create_obs_synth_spec(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, vrot_test, run_dir=None,
+                          synth_mode='moog', windows=False, scratch_dir=None, **kwargs):
+    if run_dir is None:
+        with moog_sandbox(star, root=scratch_dir) as run_dir:
+            return create_obs_synth_spec(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals, vrot_test,
+                                         run_dir=run_dir, synth_mode=synth_mode, windows=windows)
+
     # read observational spectra
-    obs_lambda_full_spectrum, obs_data_full_spectrum, delta_lambda =  get_spectra(spectrum)
-    interp_function = interp1d(obs_lambda_full_spectrum, obs_data_full_spectrum)
-    obs_lambda_interp = np.arange(np.min(fe_intervals['ll_li']),np.max(fe_intervals['ll_lf'])+round(float(delta_lambda), 3), round(float(delta_lambda), 3))
-    obs_lambda_interp = np.round(obs_lambda_interp,3)
-    obs_data_interp = interp_function(obs_lambda_interp)
-    obs_lambda_flat, obs_data_norm_flat = get_intervals_normalized_spectra(obs_lambda_interp, obs_data_interp, fe_intervals)
+    obs_lambda_flat, obs_data_norm_flat, delta_lambda, offsets = normalized_obs_spectrum(spectrum, fe_intervals)
     obs_normalized_spectra = pd.DataFrame(data=np.column_stack((obs_lambda_flat,obs_data_norm_flat)),columns=['wl','flux'])
 
 
-    create_atm_model(teff, logg, feh, vtur, star)
+    create_atm_model(teff, logg, feh, vtur, star, run_dir=run_dir)
     vmac = round(float(get_vmac(teff, logg)), 3)
     print(teff, logg, feh, vtur, vmac)
 
@@ -407,42 +1969,13 @@ def create_obs_synth_spec(star, spectrum, teff, feh, vtur, logg, ldc, instr_broa
     CDELT1 = delta_lambda
     p = [vrot_test]
 
-    
-    gap = obs_lambda[-1] - obs_lambda[0]
-    if gap <= 450:
-        lambda_i_values = [round(obs_lambda[0], 3)]
-        lambda_f_values = [round(obs_lambda[-1], 3)]
-    elif gap > 450 and gap <= 900:
-        lambda_i_values = [round(obs_lambda[0], 3), round(obs_lambda[int(len(obs_lambda)/2)], 3)]
-        lambda_f_values = [round(obs_lambda[int(len(obs_lambda)/2)-1], 3), round(obs_lambda[-1], 3)]
-    elif gap > 900:
-        lambda_i_values = [round(obs_lambda[0], 3), round(obs_lambda[int(len(obs_lambda)/3)], 3), round(obs_lambda[int(len(obs_lambda)/3*2)], 3)]
-        lambda_f_values = [round(obs_lambda[int(len(obs_lambda)/3)-1], 3), round(obs_lambda[int(len(obs_lambda)/3*2)-1], 3), round(obs_lambda[-1], 3)]
-
-    synth_data = []  # all flux values from model
-    synth_lambda = []  # all wavelength points from model
-
-    for lambda_i, lambda_f in zip(lambda_i_values, lambda_f_values):
-        moog_fe(star, p, vmac, lambda_i, lambda_f, ldc, CDELT1, instr_broad)
-        with open(RUN_PATH+'synth_fe.asc') as asc:
-            for x in asc:
-                if x[0] == ' ':
-                    entry = x.rstrip().split()
-                    synth_lambda.append(float(entry[0]))
-                    synth_data.append(float(entry[1]))
-
-    synth_data_fe = []
-    synth_lambda_fe = []
-
-    fe_intervals_list = [row for row in fe_intervals[['ll_li', 'll_lf','ll_si','ll_sf']].to_numpy()]
-
-    for i,(ll_li, ll_lf, ll_si, ll_sf) in enumerate(fe_intervals_list):
-        select_sll = np.where((synth_lambda >= ll_si) & (synth_lambda <= ll_sf))[0]
-        synth_data_fe.extend(list(np.array(synth_data)[select_sll]))
-        synth_lambda_fe.extend(list(np.array(synth_lambda)[select_sll]))
+    synth_ranges = synthesis_ranges(obs_lambda, fe_intervals, CDELT1, vmac, instr_broad, windows=windows)
+    raw_synth = raw_synthesis(star, synth_ranges, CDELT1, run_dir=run_dir) if synth_mode == 'broaden' else None
+    synth_lambda, synth_data = synth_spectrum(p, star, vmac, synth_ranges, ldc, CDELT1, instr_broad, run_dir=run_dir,
+                                              raw_synth=raw_synth)
 
     obs_flux = np.array(obs_normalized_spectra['flux'])
-    synth_data_fe = np.array(synth_data_fe)
+    synth_data_fe = IntervalIndex(synth_lambda, fe_intervals).take(synth_data)
 
     return obs_lambda, obs_flux, synth_data_fe
 
@@ -491,68 +2024,164 @@ def interpolation_function(T,log,feh):
 
 
 ### Main program:
+def run_star(star_info, fe_intervals, fit_options={}):
+    """
+    Runs the full analysis of one star (vsini with error propagation and final synthetic spectrum).
+    :param star_info: dictionary, one row of stars_information.csv
+    :param fe_intervals: pandas DataFrame of the intervals in vsini_intervals.list
+    :param fit_options: dictionary, keyword arguments passed to the fits (e.g. synth_mode)
+    :return: list, row to be saved in results_simulations.csv
+    """
+    star = star_info["star_name"]
+    spect = star_info["spectrograph"]
+    teff = float(star_info["Teff"])
+    eteff = float(star_info["eTeff"])
+    logg = float(star_info["logg"])
+    feh  = float(star_info["feh"])
+    efeh = float(star_info["efeh"])
+    vtur = float(star_info["vtur"])
+    ldc  = float(interpolation_function(teff,logg,feh))   #https://exoctk.stsci.edu/limb_darkening
+    instr_broad = float(star_info["instr_broad"])
+    spectrum = SPECTRA_PATH + star_info["fits_name"]
+
+    print(spect,spectrum,star,teff,eteff,logg,feh,efeh,vtur,ldc,instr_broad)
+    cache_start = SYNTH_CACHE.stats()
+
+    #manual_test(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals,7.0)
+
+#    vrot, vrot_err, vmac, status = get_vsini(star, spectrum, teff, feh, vtur, logg, ldc, instr_broad, fe_intervals)
+#    creating_final_synth_spectra(vrot, star, spectrum, teff, feh, vtur, logg, fe_intervals, ldc, instr_broad)
+#    print ('results', star, teff, logg, feh, spectrum, vrot, vrot_err, vmac, status)
+
+#With Error propagation
+    vrot, vrot_err, vmac, status, vsini_final_err = get_vsini_error(star, spectrum, teff, eteff, feh, efeh, vtur, logg, ldc, instr_broad, fe_intervals, **fit_options)
+    if fit_options.get('mc_draws', 0) > 0:
+        get_vsini_mc(star, spectrum, teff, eteff, feh, efeh, vtur, logg, instr_broad, fe_intervals, vrot, vrot_err,
+                     **fit_options)
+    creating_final_synth_spectra(vrot, star, spectrum, teff, feh, vtur, logg, fe_intervals, ldc, instr_broad, **fit_options)
+    print ('results', star, teff, logg, feh, spectrum, vrot, vrot_err, vmac, status, vsini_final_err)
+    cache_end = SYNTH_CACHE.stats()
+    print ('synthesis cache', star, 'hits:', cache_end['hits'] - cache_start['hits'],
+           'misses:', cache_end['misses'] - cache_start['misses'])
+
+    return [star,instr_broad,teff,logg,feh,vrot, vrot_err, vmac, status, vsini_final_err]
+
+
+def run_star_safe(star_info, fe_intervals, fit_options={}):
+    """
+    Same as run_star, but a failure of one star is reported and returned as a row with status 'failed' instead of
+    stopping the whole batch.
+    """
+    try:
+        return run_star(star_info, fe_intervals, fit_options)
+    except Exception:
+        print('Failed star', star_info["star_name"])
+        traceback.print_exc()
+        return [star_info["star_name"], star_info["instr_broad"], star_info["Teff"], star_info["logg"],
+                star_info["feh"], np.nan, np.nan, np.nan, 'failed', np.nan]
+
+
 def main():
-   
-    directory="stars_information.csv"
-    Table=pd.read_csv(directory)
 
-    star_names=list(Table["star_name"])
-    fits_directory=np.array(list(Table["fits_name"]))
+    parser = argparse.ArgumentParser(description='vsini of the stars in stars_information.csv using MOOG')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of stars analysed at the same time (default: 1)')
+    parser.add_argument('--error-workers', type=int, default=1,
+                        help='number of the five fits of the error of one star (nominal, Teff+-eTeff, '
+                             '[Fe/H]+-efeh) run at the same time (default: 1)')
+    parser.add_argument('--error-fits', choices=['warm', 'independent'], default='warm',
+                        help='warm: the Teff and [Fe/H] perturbed fits start from the nominal vsini, inside a window '
+                             'around it, and stop at a tolerance in km/s; independent: the five fits are done in the '
+                             'same way (default: warm)')
+    parser.add_argument('--synth-mode', choices=['moog', 'broaden'], default='moog',
+                        help='moog: MOOG synthesis and smoothing at every evaluation of the fit; broaden: one MOOG '
+                             'synthesis per atmosphere model, broadened in NumPy (default: moog)')
+    parser.add_argument('--method', choices=list(OPTIMIZERS) + ['grid'], default='mpfit',
+                        help='mpfit: Levenberg-Marquardt fit of vsini; brent: bounded Brent minimization of the '
+                             'chi-square; least_squares: scipy least_squares fit; grid: chi-square scan of vsini, the '
+                             'curve is saved in running_dir/<star>_chi2_curve.rdb (default: mpfit)')
+    parser.add_argument('--windows', action='store_true',
+                        help='synthesize only windows around the line intervals of vsini_intervals.list instead of '
+                             'the whole wavelength range')
+    parser.add_argument('--scratch', default=None,
+                        help='directory for the temporary MOOG files (default: %s)' % SCRATCH_PATH)
+    parser.add_argument('--start', choices=['auto', 'width', 'fixed'], default='auto',
+                        help='starting vsini of mpfit. auto: %s or, for the stars not there, the estimate from the '
+                             'widths of the lines; width: the estimate from the widths; fixed: 5 km/s '
+                             '(default: auto)' % LITERATURE_FILE)
+    parser.add_argument('--derivative', choices=['auto', 'analytic', 'numeric'], default='auto',
+                        help='analytic: derivative of the model from the rotational kernel, one synthesis per mpfit '
+                             'iteration; numeric: finite differences of mpfit; auto: analytic with --synth-mode '
+                             'broaden and numeric with --synth-mode moog (default: auto)')
+    parser.add_argument('--mc', type=int, default=0, metavar='N',
+                        help='number of Monte Carlo draws of Teff, [Fe/H] and flux noise for the error of vsini, the '
+                             'percentiles are saved in running_dir/<star>_mc_percentiles.rdb (default: 0, no Monte '
+                             'Carlo)')
+    parser.add_argument('--mc-correlation', type=float, default=0.,
+                        help='correlation coefficient between the errors of Teff and [Fe/H] (default: 0)')
+    parser.add_argument('--mc-seed', type=int, default=None,
+                        help='seed of the Monte Carlo draws (default: random)')
+    parser.add_argument('--jacobian-workers', type=int, default=1,
+                        help='number of MOOG syntheses of the numeric derivatives of mpfit run at the same time, with '
+                             '--synth-mode moog and numeric derivatives (default: 1)')
+    parser.add_argument('--per-line', action='store_true',
+                        help='fit vsini in every interval of vsini_intervals.list independently and combine them, '
+                             'the table of the lines is saved in running_dir/<star>_lines_vsini.rdb')
+    parser.add_argument('--line-workers', type=int, default=1,
+                        help='number of intervals fitted at the same time with --per-line (default: 1)')
+    args = parser.parse_args()
+    fit_options = {'synth_mode': args.synth_mode, 'method': args.method, 'windows': args.windows,
+                   'scratch_dir': args.scratch, 'derivative': args.derivative,
+                   'start': args.start, 'error_workers': args.error_workers,
+                   'error_fits': args.error_fits, 'mc_draws': args.mc, 'mc_correlation': args.mc_correlation,
+                   'mc_seed': args.mc_seed, 'per_line': args.per_line, 'line_workers': args.line_workers,
+                   'jacobian_workers': args.jacobian_workers}
 
-    N=len(star_names)  #number of data to analyse
+    directory="stars_information.csv"
+    Table=pd.read_csv(directory)
+    stars_info = Table.to_dict('records')
 
+    N=len(stars_info)  #number of data to analyse
 
     print("Running Dir:", RUN_PATH)
 
     start_time = time.time()
     fe_intervals = pd.read_csv(LINELIST_PATH+'vsini_intervals.list', sep='\t')
-    
-    for i in range(N):
-        star = star_names[i]
-        spect=list(Table[Table["star_name"]==star]["spectrograph"])[0]
-        teff = float(Table[Table["star_name"]==star]["Teff"])
-        eteff = float(Table[Table["star_name"]==star]["eTeff"])
-        logg = float(Table[Table["star_name"]==star]["logg"])
-        feh  = float(Table[Table["star_name"]==star]["feh"])
-        efeh = float(Table[Table["star_name"]==star]["efeh"])
-        vtur = float(Table[Table["star_name"]==star]["vtur"])
-        ldc  = float(interpolation_function(teff,logg,feh))   #https://exoctk.stsci.edu/limb_darkening
-        instr_broad = float(Table[Table["star_name"]==star]["instr_broad"])
-    #spectrum = "/home/pedro/OneDrive/Documentos/codes/Espetros/" + directory
-    
-        print(spect,SPECTRA_PATH+fits_directory[i],star,teff,eteff,logg,feh,efeh,vtur,ldc,instr_broad)    #manual_test(star, fits_directory[i], teff, feh, vtur, logg, ldc, instr_broad, fe_intervals,2.87)    #return#    print (star, teff, logg, feh, vtur, ldc, instr_broad, fits_directory[i])    vrot, vrot_err, vmac, status = get_vsini(star, fits_directory[i], teff, feh, vtur, logg, ldc, instr_broad, fe_intervals)#    creating_final_synth_spectra(vrot, star, fits_directory[i], teff, feh, vtur, logg, fe_intervals, ldc, instr_broad)#With Error propagation    #vrot, vrot_err, vmac, status, vsini_final_err = get_vsini_error(star, fits_directory[i], teff, eteff, feh, efeh, vtur, logg, ldc, instr_broad, fe_intervals)    #creating_final_synth_spectra(vrot, star, fits_directory[i], teff, feh, vtur, logg, fe_intervals, ldc, instr_broad)    #print ('results', star, teff, logg, feh, fits_directory[i], vrot, vrot_err, vmac, status, vsini_final_err)
-
-        #manual_test(star, SPECTRA_PATH+fits_directory[i], teff, feh, vtur, logg, ldc, instr_broad, fe_intervals,7.0)
-    #return
-
-        print (star, teff, logg, feh, vtur, ldc, instr_broad, fits_directory[i])
-
-#    vrot, vrot_err, vmac, status = get_vsini(star, fits_directory[i], teff, feh, vtur, logg, ldc, instr_broad, fe_intervals)
-#    creating_final_synth_spectra(vrot, star, fits_directory[i], teff, feh, vtur, logg, fe_intervals, ldc, instr_broad)
-#    print ('results', star, teff, logg, feh, fits_directory[i], vrot, vrot_err, vmac, status)
-
-#With Error propagation
-        vrot, vrot_err, vmac, status, vsini_final_err = get_vsini_error(star,SPECTRA_PATH+ fits_directory[i], teff, eteff, feh, efeh, vtur, logg, ldc, instr_broad, fe_intervals)
-        creating_final_synth_spectra(vrot, star, SPECTRA_PATH+fits_directory[i], teff, feh, vtur, logg, fe_intervals, ldc, instr_broad)
-        print ('results', star, teff, logg, feh, SPECTRA_PATH+fits_directory[i], vrot, vrot_err, vmac, status, vsini_final_err)
 
-    #saving the results in a csv file
-        List=[star,instr_broad,teff,logg,feh,vrot, vrot_err, vmac, status, vsini_final_err]
-    
+    if ATM_CACHE_PATH is not None:
+        atm_parameters = [parameters for star_info in stars_info for parameters in star_atm_parameters(star_info)]
+        try:
+            prebuild_atm_models(atm_parameters, workers=args.workers, scratch_dir=args.scratch)
+        except Exception:
+            # the fits build the models that are still missing
+            traceback.print_exc()
+
+    if args.workers > 1:
+        # every star is independent and runs in its own MOOG sandbox, map returns the rows in the input order
+        pool = ProcessPoolExecutor(max_workers=min(args.workers, N))
+        results = pool.map(run_star_safe, stars_info, [fe_intervals]*N, [fit_options]*N)
+    else:
+        pool = None
+        results = (run_star_safe(star_info, fe_intervals, fit_options) for star_info in stars_info)
+
+    #saving the results in a csv file, only the main process writes to it
+    for List in results:
         with open('results_simulations.csv', 'a') as f_object:
- 
+
         # Pass this file object to csv.writer()
         # and get a writer object
-    
+
             writer_object = writer(f_object)
- 
+
         # Pass the list as an argument into
         # the writerow()
             writer_object.writerow(List)
- 
-        # Close the file object
-            f_object.close()
-    
+
+    if pool is not None:
+        pool.shutdown()
+
+    print('Finished %d stars in %.1f s' % (N, time.time() - start_time))
+
 
 if __name__ == "__main__":
     main()